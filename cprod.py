@@ -1,12 +1,54 @@
-from flask import Flask, render_template_string, request
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, render_template_string, request, jsonify, send_file, abort
+from flask_socketio import SocketIO
+from engineio import packet as eio_packet
+from socketio import packet as sio_packet
 import eventlet
+from eventlet import tpool
+import argparse
+import atexit
+import base64
+import functools
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import json
+import re
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from itertools import count
 from datetime import datetime
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # Standard eventlet patch for stability
 eventlet.monkey_patch()
 
-app = Flask(__name__)
+# Static files are served by the asset pipeline below, not Flask's static route
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'secure_chat_key'
 
 # Max buffer size set to 10MB to allow large GIFs
@@ -17,20 +59,746 @@ socketio = SocketIO(app,
                     max_http_buffer_size=10 * 1024 * 1024)
 
 # Global dictionary to track connected users: {session_id: username}
+# With several server processes this holds the sessions of all of them.
 CONNECTED_USERS = {}
-
-@app.route('/')
-def index():
-    return render_template_string("""
+# Sessions grouped by the server process they are connected to: {worker_id: set(session_id)}
+WORKER_SESSIONS = {}
+# Reverse of CONNECTED_USERS, one entry per open tab: {username: set(session_id)}
+USER_SIDS = {}
+
+# Presence changes are collected and broadcast as one delta per interval (seconds)
+PRESENCE_INTERVAL = 0.25
+
+# Channel every client starts in, what channel names may look like, and how
+# many channels one session can be in at once
+DEFAULT_CHANNEL = 'general'
+CHANNEL_RE = re.compile(r'^[\w-]{1,32}$')
+MAX_CHANNELS_PER_SESSION = 16
+# Members of each channel across all processes: {channel: set(session_id)}
+CHANNEL_SESSIONS = {}
+# Channels each session is in: {session_id: set(channel)}
+SESSION_CHANNELS = {}
+# Joins this process published that haven't come back over the bus yet:
+# {session_id: set(channel)}
+PENDING_JOINS = {}
+
+# --- Media Store ---
+# Uploaded images are stored on disk under their SHA-256 hash, so chat messages
+# only carry a short /media/<hash> URL instead of the whole file.
+MEDIA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media')
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Sent to the page, which downscales and re-encodes still images to these
+# settings before uploading them. Animated images are uploaded untouched.
+CLIENT_UPLOAD_CONFIG = {
+    'max_edge': 2560,
+    'type': 'image/webp',
+    'quality': 0.85,
+    # Files larger than this are sent as resumable chunks of this size
+    'chunk_size': 1024 * 1024,
+}
+
+# Magic bytes of the image formats we accept: {prefix: mimetype}
+IMAGE_SIGNATURES = {
+    b'\x89PNG\r\n\x1a\n': 'image/png',
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'GIF87a': 'image/gif',
+    b'GIF89a': 'image/gif',
+    b'BM': 'image/bmp',
+}
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+DATA_URL_RE = re.compile(r'^data:image/[\w.+-]+;base64,')
+
+# Resized copies made of still images, smallest first: {variant: longest edge in pixels}
+# Messages show the preview, the original only loads when it is clicked.
+IMAGE_VARIANTS = {'preview': 480, 'display': 1280}
+VARIANT_QUALITY = 80
+
+# Animated GIFs get an animated WebP copy, which is usually a fraction of the
+# size. Uploads wait up to GIF_TRANSCODE_WAIT seconds for it, after that the
+# GIF is sent as is and later messages with the same GIF use the copy.
+GIF_TRANSCODE = True
+GIF_TRANSCODE_WAIT = 2
+GIF_QUALITY = 75
+
+MEDIA_VARIANTS = tuple(IMAGE_VARIANTS) + ('animated',)
+
+# Each image's dimensions and a tiny preview (longest edge in pixels) are
+# kept next to it in a small JSON file, so pages can reserve its space and
+# show something before it loads
+PLACEHOLDER_EDGE = 16
+PLACEHOLDER_QUALITY = 40
+
+# The store is capped in total size, files are evicted least recently used
+# first, and files older than MEDIA_RETENTION seconds are removed regardless.
+MEDIA_QUOTA = 2 * 1024 * 1024 * 1024
+MEDIA_RETENTION = 30 * 24 * 60 * 60
+MEDIA_SWEEP_INTERVAL = 60
+
+# In-memory index of stored media, least recently used first:
+# {sha256: {'type': mimetype, 'variants': [variant, ...], 'size': bytes incl. variants,
+#           'stored': time, 'accessed': time, 'info': {'width', 'height', 'placeholder'} or None}}
+MEDIA_INDEX = OrderedDict()
+# Total size of the files in MEDIA_INDEX
+MEDIA_SIZE = 0
+# GIFs currently being transcoded: {sha256: GreenThread}
+TRANSCODING = {}
+# Media served by this process since it last told the hub, which does the evicting
+MEDIA_USED = set()
+
+os.makedirs(MEDIA_DIR, exist_ok=True)
+
+def sniff_image_type(head):
+    for signature, mimetype in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def media_path(sha, variant=None):
+    return os.path.join(MEDIA_DIR, sha if variant is None else '%s-%s' % (sha, variant))
+
+def add_media_entry(sha, mimetype, variants, stored=None, accessed=None, info=None):
+    global MEDIA_SIZE
+    now = time.time()
+    size = sum(os.path.getsize(media_path(sha, v)) for v in [None] + variants)
+    MEDIA_INDEX[sha] = {'type': mimetype, 'variants': variants, 'size': size,
+                        'stored': stored or now, 'accessed': accessed or now, 'info': info}
+    MEDIA_SIZE += size
+    return MEDIA_INDEX[sha]
+
+def index_media(sha):
+    """Adds a stored file and its variants to MEDIA_INDEX, returns the entry or None."""
+    try:
+        with open(media_path(sha), 'rb') as f:
+            mimetype = sniff_image_type(f.read(16))
+            stat = os.fstat(f.fileno())
+    except FileNotFoundError:
+        return None
+    if mimetype is None:
+        return None
+    variants = [v for v in MEDIA_VARIANTS if os.path.exists(media_path(sha, v))]
+    return add_media_entry(sha, mimetype, variants, stat.st_mtime, max(stat.st_atime, stat.st_mtime),
+                           read_media_info(sha))
+
+def read_media_info(sha):
+    # Files stored before image info was recorded, or that Pillow couldn't read, have none
+    try:
+        with open(media_path(sha, 'info')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def load_media_index():
+    # The only directory scan, afterwards the index is kept up to date as files come and go
+    for name in os.listdir(MEDIA_DIR):
+        if HASH_RE.match(name):
+            index_media(name)
+        elif name.endswith('.part'):
+            remove_stale(os.path.join(MEDIA_DIR, name))
+    for sha in sorted(MEDIA_INDEX, key=lambda sha: MEDIA_INDEX[sha]['accessed']):
+        MEDIA_INDEX.move_to_end(sha)
+
+def store_media(chunks):
+    """Stream chunks into the media store, returns (sha256, mimetype).
+
+    Raises ValueError if the data is too large or not a supported image.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    fd, tmp_path = tempfile.mkstemp(dir=MEDIA_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise ValueError('File too large')
+                if len(head) < 16:
+                    head += chunk[:16]
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return commit_media(tmp_path, digest.hexdigest(), head)
+
+def commit_media(tmp_path, sha, head):
+    """Moves a fully written file into the store under its hash, returns (sha256, mimetype)."""
+    mimetype = sniff_image_type(head)
+    if mimetype is None:
+        os.unlink(tmp_path)
+        raise ValueError('Unsupported file type')
+    # Same content -> same name, so re-uploads simply replace an identical file
+    os.replace(tmp_path, media_path(sha))
+    if sha in MEDIA_INDEX:
+        # Posted again, so its retention period starts over too
+        MEDIA_INDEX[sha]['stored'] = time.time()
+        touch_media(sha)
+        announce_media(sha)
+        return sha, mimetype
+    variants, info = tpool.execute(make_variants, sha)
+    add_media_entry(sha, mimetype, variants, info=info)
+    announce_media(sha)
+    enforce_media_limits()
+    if mimetype == 'image/gif' and GIF_TRANSCODE and Image is not None:
+        transcode = start_transcode(sha)
+        with eventlet.Timeout(GIF_TRANSCODE_WAIT, False):
+            transcode.wait()
+    return sha, mimetype
+
+def make_variants(sha):
+    """Writes the resized copies and the info file of a stored image, returns (names, info).
+
+    Runs in a tpool thread since decoding and resizing would block the hub.
+    """
+    if Image is None:
+        return [], None
+    made = []
+    info = None
+    try:
+        with Image.open(media_path(sha)) as original:
+            animated = getattr(original, 'is_animated', False)
+            image = ImageOps.exif_transpose(original)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            info = describe_image(image)
+            tmp_path = media_path(sha, 'info') + '.part'
+            with open(tmp_path, 'w') as f:
+                json.dump(info, f)
+            os.replace(tmp_path, media_path(sha, 'info'))
+            if animated:
+                # Animated images keep their frames, the first one only describes them
+                return made, info
+            for variant, edge in IMAGE_VARIANTS.items():
+                if max(image.size) <= edge:
+                    break
+                resized = image.copy()
+                resized.thumbnail((edge, edge), Image.LANCZOS)
+                tmp_path = media_path(sha, variant) + '.part'
+                resized.save(tmp_path, 'WEBP', quality=VARIANT_QUALITY)
+                os.replace(tmp_path, media_path(sha, variant))
+                made.append(variant)
+    except Exception:
+        # Pillow can't handle every file we accept, those are shown as they are
+        pass
+    return made, info
+
+def describe_image(image):
+    tiny = image.copy()
+    tiny.thumbnail((PLACEHOLDER_EDGE, PLACEHOLDER_EDGE))
+    buffer = io.BytesIO()
+    tiny.save(buffer, 'WEBP', quality=PLACEHOLDER_QUALITY)
+    return {'width': image.width, 'height': image.height,
+            'placeholder': 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')}
+
+def transcode_gif(sha):
+    """Writes an animated WebP copy of a GIF, returns False if it wouldn't be smaller.
+
+    Runs in a tpool thread.
+    """
+    tmp_path = media_path(sha, 'animated') + '.part'
+    try:
+        with Image.open(media_path(sha)) as gif:
+            gif.save(tmp_path, 'WEBP', save_all=True, quality=GIF_QUALITY, method=4)
+        if os.path.getsize(tmp_path) >= os.path.getsize(media_path(sha)):
+            os.unlink(tmp_path)
+            return False
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return False
+    os.replace(tmp_path, media_path(sha, 'animated'))
+    return True
+
+def start_transcode(sha):
+    def run():
+        try:
+            if tpool.execute(transcode_gif, sha) and sha in MEDIA_INDEX:
+                add_variant(sha, 'animated')
+        finally:
+            TRANSCODING.pop(sha, None)
+    # Transcoding is keyed by content hash, so a popular GIF is only done once
+    if sha not in TRANSCODING:
+        TRANSCODING[sha] = eventlet.spawn(run)
+    return TRANSCODING[sha]
+
+def read_stream(stream, limit=None):
+    while limit is None or limit > 0:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE if limit is None else min(limit, UPLOAD_CHUNK_SIZE))
+        if not chunk:
+            return
+        if limit is not None:
+            limit -= len(chunk)
+        yield chunk
+
+def hash_file(path):
+    """Returns (sha256, first bytes) of a file. Runs in a tpool thread."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        head = f.read(16)
+        digest.update(head)
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest(), head
+
+# --- Chunked Uploads ---
+# Large files are sent in chunks at increasing offsets to a temp file, so an
+# interrupted upload can resume where it stopped and no chunk sits in memory.
+UPLOAD_TMP_DIR = os.path.join(MEDIA_DIR, 'uploads')
+MAX_CHUNKED_UPLOAD_SIZE = 100 * 1024 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# Unfinished uploads are discarded after this many seconds without a chunk
+UPLOAD_EXPIRY = 60 * 60
+
+# {upload_id: {'size': declared size, 'sha256': declared hash, 'updated': time,
+#              'lock': held while a chunk is written}}
+UPLOADS = {}
+
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+
+def upload_path(upload_id):
+    return os.path.join(UPLOAD_TMP_DIR, upload_id)
+
+def upload_offset(upload_id):
+    try:
+        return os.path.getsize(upload_path(upload_id))
+    except OSError:
+        return 0
+
+def remove_stale(path):
+    # Temp files nobody has written to for UPLOAD_EXPIRY were left behind by a
+    # process that stopped half way; newer ones may belong to another process
+    try:
+        if os.path.getmtime(path) < time.time() - UPLOAD_EXPIRY:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def expire_uploads():
+    now = time.monotonic()
+    for upload_id, upload in list(UPLOADS.items()):
+        if now - upload['updated'] > UPLOAD_EXPIRY:
+            del UPLOADS[upload_id]
+            if os.path.exists(upload_path(upload_id)):
+                os.unlink(upload_path(upload_id))
+    # Uploads from before a restart, or another server process's
+    for name in os.listdir(UPLOAD_TMP_DIR):
+        if name not in UPLOADS:
+            remove_stale(upload_path(name))
+
+def lookup_media(sha):
+    """Returns the MEDIA_INDEX entry of a stored file, or None if it doesn't exist."""
+    entry = MEDIA_INDEX.get(sha)
+    if entry is None and HASH_RE.match(sha):
+        # Another server process may have stored it
+        entry = index_media(sha)
+    return entry
+
+def media_url(sha, variant=None):
+    return '/media/' + sha if variant is None else '/media/%s/%s' % (sha, variant)
+
+def media_info(url):
+    """Extra fields sent with an image message that points into the media store."""
+    if not url.startswith('/media/'):
+        return None
+    sha = url[len('/media/'):]
+    entry = lookup_media(sha)
+    if entry is None:
+        return None
+    info = {variant: media_url(sha, variant) for variant in entry['variants']}
+    if entry['info']:
+        info.update(entry['info'])
+    return info
+
+def media_expired(data):
+    url = data.get('url') or ''
+    return (data.get('type') == 'image' and url.startswith('/media/')
+            and lookup_media(url[len('/media/'):]) is None)
+
+def mark_expired(messages):
+    # Images evicted from the store are shown as a placeholder instead of a broken image
+    for data in messages:
+        if media_expired(data):
+            data['expired'] = True
+    return messages
+
+def store_data_url(url):
+    # Older pages still send images inline as base64 data URLs
+    payload = base64.b64decode(url[url.index(',') + 1:], validate=True)
+    sha, _ = store_media([payload])
+    return media_url(sha)
+
+# --- Media Retention ---
+
+def mark_accessed(sha):
+    MEDIA_INDEX[sha]['accessed'] = time.time()
+    MEDIA_INDEX.move_to_end(sha)
+
+def touch_media(sha):
+    mark_accessed(sha)
+    if not BUS.is_hub:
+        MEDIA_USED.add(sha)
+
+def announce_media(sha):
+    # The hub does the evicting, so it hears about files stored by other processes right away
+    if not BUS.is_hub:
+        BUS.publish('media_stored', {'sha': sha, 'stored': MEDIA_INDEX[sha]['stored']})
+
+def report_media_use():
+    # Access order only has to be roughly right, so it reaches the hub once per sweep
+    if MEDIA_USED and not BUS.is_hub:
+        BUS.publish('media_used', {'shas': list(MEDIA_USED)})
+    MEDIA_USED.clear()
+
+def add_variant(sha, variant):
+    global MEDIA_SIZE
+    entry = MEDIA_INDEX[sha]
+    size = os.path.getsize(media_path(sha, variant))
+    entry['variants'].append(variant)
+    entry['size'] += size
+    MEDIA_SIZE += size
+
+def forget_media(sha):
+    global MEDIA_SIZE
+    entry = MEDIA_INDEX.pop(sha, None)
+    if entry is not None:
+        MEDIA_SIZE -= entry['size']
+    return entry
+
+def evict_media(sha):
+    entry = forget_media(sha)
+    for variant in [None] + entry['variants'] + ['info']:
+        try:
+            os.unlink(media_path(sha, variant))
+        except FileNotFoundError:
+            pass
+    # Other server processes drop it from their index too
+    BUS.publish('media_evicted', {'sha': sha})
+
+def enforce_media_limits():
+    # Only the hub evicts, so processes don't race each other deleting files
+    if not BUS.is_hub:
+        return
+    cutoff = time.time() - MEDIA_RETENTION
+    for sha in [sha for sha, entry in MEDIA_INDEX.items() if entry['stored'] < cutoff]:
+        evict_media(sha)
+    while MEDIA_SIZE > MEDIA_QUOTA and MEDIA_INDEX:
+        evict_media(next(iter(MEDIA_INDEX)))
+
+def media_sweep_loop():
+    while True:
+        socketio.sleep(MEDIA_SWEEP_INTERVAL)
+        report_media_use()
+        enforce_media_limits()
+        expire_uploads()
+
+load_media_index()
+socketio.start_background_task(media_sweep_loop)
+
+# --- Message History ---
+# Bounded by both message count and total payload bytes so memory stays flat
+HISTORY_MAX_MESSAGES = 500
+HISTORY_MAX_BYTES = 2 * 1024 * 1024
+# Number of messages replayed to a client when it registers
+HISTORY_REPLAY_COUNT = 50
+# Largest page a client can request when scrolling back
+HISTORY_PAGE_MAX = 200
+# Most messages a reconnecting client is sent as a delta, one that is further
+# behind gets a fresh replay instead
+HISTORY_RESYNC_MAX = 500
+
+class MessageHistory:
+    # Messages are stored as plain tuples instead of dicts to keep them compact
+    FIELDS = ('id', 'username', 'type', 'msg', 'url', 'timestamp', 'channel', 'media')
+    CHANNEL = FIELDS.index('channel')
+
+    def __init__(self, max_messages, max_bytes):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = deque()
+        self.size = 0
+
+    @staticmethod
+    def entry_size(entry):
+        return sum(len(value) for value in entry[1:] if value)
+
+    @classmethod
+    def pack(cls, data):
+        media = data.get('media')
+        return ((data['id'],)
+                + tuple(str(data[field]) if data.get(field) is not None else None
+                        for field in cls.FIELDS[1:-1])
+                + (json.dumps(media, separators=(',', ':')) if media else None,))
+
+    def append(self, entry):
+        size = self.entry_size(entry)
+        if size > self.max_bytes:
+            return
+        self.entries.append(entry)
+        self.size += size
+        while len(self.entries) > self.max_messages or self.size > self.max_bytes:
+            self.size -= self.entry_size(self.entries.popleft())
+
+    def before(self, message_id, count, channel):
+        # Returns up to count entries of the channel older than message_id, oldest first
+        page = []
+        for entry in reversed(self.entries):
+            if entry[0] < message_id and entry[self.CHANNEL] == channel:
+                page.append(entry)
+                if len(page) == count:
+                    break
+        page.reverse()
+        return page
+
+    def after(self, message_id, count, channel):
+        # Returns up to count entries of the channel newer than message_id, oldest first
+        page = []
+        for entry in reversed(self.entries):
+            if entry[0] <= message_id:
+                break
+            if entry[self.CHANNEL] == channel:
+                page.append(entry)
+        page.reverse()
+        return page[:count]
+
+    def oldest_id(self):
+        return self.entries[0][0] if self.entries else None
+
+    @classmethod
+    def unpack(cls, entry):
+        data = dict(zip(cls.FIELDS, entry))
+        if data['media']:
+            data['media'] = json.loads(data['media'])
+        return data
+
+HISTORY = MessageHistory(HISTORY_MAX_MESSAGES, HISTORY_MAX_BYTES)
+
+# --- Message Log ---
+# Append-only SQLite log so history survives restarts. Inserts are queued and
+# committed in batches from a background task, off the eventlet hub thread.
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat.db')
+DB_FLUSH_INTERVAL = 0.5
+DB_COLUMNS = ', '.join(MessageHistory.FIELDS)
+
+PENDING_MESSAGES = []
+
+def open_db():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # In WAL mode NORMAL only syncs on checkpoints, which is enough for a chat log
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+                        id INTEGER PRIMARY KEY,
+                        username TEXT,
+                        type TEXT,
+                        msg TEXT,
+                        url TEXT,
+                        timestamp TEXT,
+                        channel TEXT,
+                        media TEXT)''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(messages)')]
+    if 'media' not in columns:
+        # Logs written before image variants existed
+        conn.execute('ALTER TABLE messages ADD COLUMN media TEXT')
+    if 'channel' not in columns:
+        # Logs written before channels existed, everything was said in the default one
+        conn.execute("ALTER TABLE messages ADD COLUMN channel TEXT NOT NULL DEFAULT '%s'"
+                     % DEFAULT_CHANNEL)
+    conn.execute('CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel, id)')
+    return conn
+
+DB = open_db()
+
+def write_messages(rows):
+    with DB:
+        DB.executemany('INSERT OR IGNORE INTO messages (%s) VALUES (%s)'
+                       % (DB_COLUMNS, ', '.join('?' * len(MessageHistory.FIELDS))), rows)
+
+def flush_messages():
+    """Writes out queued messages, returns False if the log couldn't take them."""
+    global PENDING_MESSAGES
+    if PENDING_MESSAGES:
+        rows, PENDING_MESSAGES = PENDING_MESSAGES, []
+        try:
+            tpool.execute(write_messages, rows)
+        except (sqlite3.Error, OSError) as e:
+            # Requeue them ahead of anything logged meanwhile, the next flush retries
+            PENDING_MESSAGES = rows + PENDING_MESSAGES
+            print("[!] Could not write to the message log: %s" % e, file=sys.stderr)
+            return False
+    return True
+
+def flush_loop():
+    while True:
+        socketio.sleep(DB_FLUSH_INTERVAL)
+        flush_messages()
+
+def log_message(entry):
+    PENDING_MESSAGES.append(entry)
+
+def load_history():
+    # Only the tail is needed to fill the in-memory history
+    rows = DB.execute('SELECT %s FROM messages ORDER BY id DESC LIMIT ?' % DB_COLUMNS,
+                      (HISTORY_MAX_MESSAGES,)).fetchall()
+    for row in reversed(rows):
+        HISTORY.append(row)
+    return rows[0][0] if rows else 0
+
+last_id = load_history()
+MESSAGE_IDS = count(last_id + 1)
+# Id of the first message ever logged, used to tell when memory holds everything
+FIRST_MESSAGE_ID = DB.execute('SELECT MIN(id) FROM messages').fetchone()[0] or last_id + 1
+# Id of the first message in each channel, to tell when scrolling back is done: {channel: id}
+FIRST_CHANNEL_IDS = dict(DB.execute('SELECT channel, MIN(id) FROM messages GROUP BY channel'))
+
+def read_messages(before, limit, channel):
+    rows = DB.execute('SELECT %s FROM messages WHERE channel = ? AND id < ? ORDER BY id DESC LIMIT ?'
+                      % DB_COLUMNS, (channel, before, limit)).fetchall()
+    rows.reverse()
+    return rows
+
+def read_messages_after(after, limit, channel):
+    return DB.execute('SELECT %s FROM messages WHERE channel = ? AND id > ? ORDER BY id LIMIT ?'
+                      % DB_COLUMNS, (channel, after, limit)).fetchall()
+
+def read_log(reader, *args):
+    """Runs a log query off the hub, returns None if the log can't be read right now."""
+    if not flush_messages():
+        # Rows still queued would be missing from the result
+        return None
+    try:
+        return tpool.execute(reader, *args)
+    except (sqlite3.Error, OSError) as e:
+        print("[!] Could not read the message log: %s" % e, file=sys.stderr)
+        return None
+
+def fetch_since(after, channel):
+    """Returns the channel's messages newer than the `after` id, or None if there are too many."""
+    oldest = HISTORY.oldest_id()
+    if oldest is not None and after >= oldest - 1:
+        page = HISTORY.after(after, HISTORY_RESYNC_MAX + 1, channel)
+    else:
+        page = read_log(read_messages_after, after, HISTORY_RESYNC_MAX + 1, channel)
+        if page is None:
+            return None
+    if len(page) > HISTORY_RESYNC_MAX:
+        return None
+    return {'messages': mark_expired([MessageHistory.unpack(entry) for entry in page]),
+            'since': after}
+
+def fetch_history(before, limit, channel):
+    """Returns a page of the channel's messages older than the `before` id, oldest first."""
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    page = HISTORY.before(before, limit, channel)
+    if len(page) < limit and HISTORY.oldest_id() != FIRST_MESSAGE_ID:
+        # Memory doesn't reach back far enough, read the page from the log
+        logged = read_log(read_messages, before, limit, channel)
+        if logged is not None:
+            page = logged
+    has_more = bool(page) and page[0][0] != FIRST_CHANNEL_IDS.get(channel)
+    return {'messages': mark_expired([MessageHistory.unpack(entry) for entry in page]),
+            'has_more': has_more}
+
+def parse_history_args(args):
+    try:
+        before = int(args.get('before') or sys.maxsize)
+        limit = int(args.get('limit') or HISTORY_REPLAY_COUNT)
+    except (TypeError, ValueError):
+        return None
+    channel = args.get('channel') or DEFAULT_CHANNEL
+    if not valid_channel(channel):
+        return None
+    return before, limit, channel
+
+socketio.start_background_task(flush_loop)
+# Write out whatever is still queued when the server stops
+atexit.register(lambda: write_messages(PENDING_MESSAGES))
+
+# --- Static Assets ---
+# Everything the page needs is served locally so it works on a LAN without
+# internet access. Files get a content hash in their URL and are cached forever.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'image/svg+xml')
+
+def compress_variants(body, etag, mimetype):
+    """Precompresses a body once: {encoding: (body, etag)}"""
+    variants = {'identity': (body, etag)}
+    if mimetype.startswith(COMPRESSIBLE_TYPES):
+        variants['gzip'] = (gzip.compress(body, compresslevel=9), etag + '-gzip')
+        if brotli is not None:
+            variants['br'] = (brotli.compress(body, quality=11), etag + '-br')
+    return variants
+
+def encoded_response(variants, mimetype):
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in variants and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    body, etag = variants[encoding]
+    response = Response(body, mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    if len(variants) > 1:
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    return response
+
+def load_assets():
+    """Returns ({name: url}, {hashed name: (variants, mimetype)})"""
+    urls = {}
+    files = {}
+    for name in sorted(os.listdir(STATIC_DIR)):
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        hashed_name = '%s.%s%s' % (stem, digest, ext)
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        urls[name] = '/assets/' + hashed_name
+        files[hashed_name] = (compress_variants(body, digest, mimetype), mimetype)
+    return urls, files
+
+ASSET_URLS, ASSET_FILES = load_assets()
+
+def asset(name):
+    return ASSET_URLS[name]
+
+@app.route('/assets/<name>')
+def assets(name):
+    if name not in ASSET_FILES:
+        abort(404)
+    variants, mimetype = ASSET_FILES[name]
+    response = encoded_response(variants, mimetype)
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+# --- Chat Page ---
+INDEX_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
     <title>LAN Chat</title>
     <meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1">
-    <script src="https://cdn.socket.io/4.7.5/socket.io.min.js"></script>
-    <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600&display=swap" rel="stylesheet">
+    <script src="{{ asset('socket.io.min.js') }}"></script>
+    <script src="{{ asset('msgpack.js') }}"></script>
+    <script src="{{ asset('sha256.js') }}"></script>
+    
+    <link rel="preload" href="{{ asset('Inter-Regular.woff2') }}" as="font" type="font/woff2" crossorigin>
     
     <style>
+        /* Inter (SIL Open Font License, see Inter-LICENSE.txt) */
+        @font-face { font-family: 'Inter'; font-style: normal; font-weight: 400; font-display: swap; src: url("{{ asset('Inter-Regular.woff2') }}") format('woff2'); }
+        @font-face { font-family: 'Inter'; font-style: normal; font-weight: 500; font-display: swap; src: url("{{ asset('Inter-Medium.woff2') }}") format('woff2'); }
+        @font-face { font-family: 'Inter'; font-style: normal; font-weight: 600; font-display: swap; src: url("{{ asset('Inter-SemiBold.woff2') }}") format('woff2'); }
+
         /* --- THEME VARIABLES --- */
         :root {
             /* Default: Blue */
@@ -106,6 +874,11 @@ def index():
 
         .header-controls { display: flex; align-items: center; gap: 10px; }
 
+        /* --- Channel Picker --- */
+        .channel-picker { display: flex; align-items: center; gap: 2px; padding: 6px 10px; border-radius: 20px; background: rgba(128,128,128,0.05); color: var(--text-secondary); font-weight: 600; }
+        #channel { border: none; background: transparent; color: var(--text-main); font-weight: 600; font-size: 0.9rem; width: 90px; font-family: inherit; }
+        #channel:focus { outline: none; color: var(--primary); }
+
         /* --- Online Status --- */
         .online-wrapper { position: relative; cursor: pointer; display: flex; align-items: center; gap: 6px; padding: 6px 12px; border-radius: 20px; transition: background 0.2s; }
         .online-wrapper:hover { background: rgba(128,128,128,0.1); }
@@ -130,6 +903,7 @@ def index():
         .online-wrapper:hover .user-tooltip { display: block; }
         .tooltip-header { padding: 8px 16px; font-size: 0.75rem; text-transform: uppercase; color: var(--text-secondary); font-weight: 600; border-bottom: 1px solid var(--input-border); }
         .user-item { padding: 8px 16px; font-size: 0.9rem; display: flex; align-items: center; gap: 8px; }
+        .user-item:hover { background: rgba(128,128,128,0.1); }
         .user-item::before { content: ''; display: block; width: 6px; height: 6px; background: #10b981; border-radius: 50%; }
 
         /* --- Chat Area --- */
@@ -143,6 +917,8 @@ def index():
             scroll-behavior: smooth;
         }
 
+        .message-block { display: flex; flex-direction: column; gap: 16px; }
+        .message-block.settled .message-row { animation: none; }
         .message-row { display: flex; flex-direction: column; max-width: 65%; width: fit-content; animation: slideUp 0.3s ease-out; }
         .message-row.self { align-self: flex-end; align-items: flex-end; }
         
@@ -162,6 +938,8 @@ def index():
             border-bottom-left-radius: 4px;
         }
 
+        .message-row.private .message-bubble { outline: 2px dashed var(--primary-light); outline-offset: 2px; }
+
         .message-row.self .message-bubble { 
             background: var(--primary); 
             color: white; 
@@ -194,11 +972,22 @@ def index():
             max-width: 100%; 
             border-radius: 12px; 
             display: block; 
+            height: auto;
             margin-bottom: 5px;
             cursor: pointer;
             transition: transform 0.2s;
         }
         .chat-image:hover { transform: scale(1.02); }
+        .chat-image.placeholder { background-size: cover; }
+
+        .media-expired {
+            padding: 24px 32px;
+            border-radius: 12px;
+            background: rgba(128,128,128,0.15);
+            font-size: 0.85rem;
+            text-align: center;
+            margin-bottom: 5px;
+        }
 
         /* --- Input Area --- */
         .input-wrapper { 
@@ -341,6 +1130,11 @@ def index():
         </div>
 
         <div class="header-controls">
+            <label class="channel-picker" title="Channel, press Enter to switch">
+                <span>#</span>
+                <input id="channel" autocomplete="off" spellcheck="false">
+            </label>
+
             <div class="online-wrapper">
                 <div class="status-dot"></div>
                 <div class="online-count" id="onlineStatus">Loading...</div>
@@ -396,6 +1190,47 @@ def index():
 
     <script>
         const socket = io({ reconnection: true });
+
+        // --- Binary packets ---
+        // Once the server agrees at register, events travel as MessagePack
+        // instead of JSON. Incoming events are decoded whichever way they came.
+        let binaryPackets = false;
+        // Chat sends wait until the server has registered us and joined our
+        // channel. socket.io replays what was emitted while offline before
+        // our connect handler runs, which is too early.
+        let registered = false;
+        let heldPackets = [];
+
+        function unpack(data) {
+            return data instanceof ArrayBuffer ? msgpack.decode(data) : data;
+        }
+
+        function onPacket(event, handler) {
+            socket.on(event, data => handler(unpack(data)));
+        }
+
+        function emitPacket(event, data) {
+            if (!registered) {
+                heldPackets.push([event, data]);
+                return;
+            }
+            socket.emit(event, binaryPackets ? msgpack.encode(data) : data);
+        }
+
+        // A full reload replays recent history, otherwise a reconnect only
+        // asks for what was said after the last message we saw
+        function register(full) {
+            const options = { channels: [currentChannel] };
+            if (window.msgpack) options.encoding = 'msgpack';
+            if (full !== true && lastSeenId !== null) options.since = { [currentChannel]: lastSeenId };
+            socket.emit('register', usernameInput.value || "Anon", options, (res) => {
+                binaryPackets = !!res && res.encoding === 'msgpack';
+                registered = true;
+                const held = heldPackets;
+                heldPackets = [];
+                held.forEach(([event, data]) => emitPacket(event, data));
+            });
+        }
         
         // --- THEME LOGIC ---
         const colors = [
@@ -479,7 +1314,7 @@ def index():
         // --- CHAT LOGIC ---
         let unreadCount = 0;
         const originalTitle = document.title;
-        const beepUrl = "https://www.myinstants.com/media/sounds/discord-notification.mp3"; 
+        const beepUrl = "{{ asset('discord-notification.mp3') }}";
         const audio = new Audio(beepUrl);
 
         if(localStorage.getItem('chat_username')) {
@@ -504,7 +1339,7 @@ def index():
                 if (document.hidden && Notification.permission === "granted") {
                     new Notification(`New message from ${sender}`, {
                         body: msg,
-                        icon: 'https://cdn-icons-png.flaticon.com/512/134/134914.png'
+                        icon: "{{ asset('notification-icon.png') }}"
                     });
                 }
             }
@@ -514,33 +1349,113 @@ def index():
             messages.scrollTop = messages.scrollHeight;
         }
 
-        function addMessage(data) {
+        function nearBottom() {
+            return messages.scrollHeight - messages.scrollTop - messages.clientHeight < 150;
+        }
+
+        // --- Virtualized message list ---
+        // Messages are kept in blocks of MESSAGE_BLOCK_SIZE. Blocks far outside
+        // the viewport keep only their data and measured height: their nodes, and
+        // the decoded images in them, are dropped until they scroll back near.
+        const MESSAGE_BLOCK_SIZE = 25;
+        const blockObserver = new IntersectionObserver((entries) => {
+            entries.forEach(entry => {
+                if (entry.isIntersecting) restoreBlock(entry.target);
+                else collapseBlock(entry.target);
+            });
+        }, { root: messages, rootMargin: '1500px 0px' });
+
+        function createBlock(list) {
+            const block = document.createElement('div');
+            block.className = 'message-block';
+            block.messageData = list;
+            block.collapsed = false;
+            list.forEach(data => block.appendChild(renderMessage(data)));
+            return block;
+        }
+
+        function collapseBlock(block) {
+            if (block.collapsed) return;
+            block.style.height = `${block.offsetHeight}px`;
+            block.querySelectorAll('img').forEach(img => {
+                // Without a source the browser can drop the decoded image right away
+                img.onerror = null;
+                img.removeAttribute('srcset');
+                img.removeAttribute('src');
+            });
+            block.replaceChildren();
+            block.collapsed = true;
+        }
+
+        function restoreBlock(block) {
+            if (!block.collapsed) return;
+            block.classList.add('settled');
+            block.replaceChildren(...block.messageData.map(data => renderMessage(data)));
+            block.style.height = '';
+            block.collapsed = false;
+        }
+
+        function clearMessages() {
+            blockObserver.disconnect();
+            messages.replaceChildren();
+        }
+
+        function addMessage(data, silent) {
+            appendMessages([data], silent);
+        }
+
+        // Renders a batch of messages with one insertion per block and a single reflow
+        function appendMessages(list, silent) {
+            if (!list.length) return;
+            const stick = nearBottom() || list[list.length - 1].username === usernameInput.value;
+            let block = messages.lastElementChild;
+            let fragment = null;
+            list.forEach(data => {
+                if (typeof data.id === 'number') lastSeenId = Math.max(lastSeenId || 0, data.id);
+                if (!block || block.collapsed || block.messageData.length >= MESSAGE_BLOCK_SIZE) {
+                    if (fragment) block.appendChild(fragment);
+                    fragment = null;
+                    block = createBlock([]);
+                    messages.appendChild(block);
+                    blockObserver.observe(block);
+                }
+                fragment = fragment || document.createDocumentFragment();
+                block.messageData.push(data);
+                fragment.appendChild(renderMessage(data));
+            });
+            if (fragment) block.appendChild(fragment);
+            if (stick) scrollToBottom();
+            // One notification for the whole batch, about its newest message
+            const last = list[list.length - 1];
+            if (last && last.type !== 'system' && !silent) {
+                const notifyText = last.type === 'image' ? (last.msg || 'sent an image') : last.msg;
+                notifyUser(last.username, notifyText);
+            }
+        }
+
+        function renderMessage(data) {
             const isMe = data.username === usernameInput.value;
             
             if (data.type === 'system') {
                 const sysDiv = document.createElement("div");
                 sysDiv.className = "system-message";
                 sysDiv.innerText = data.msg;
-                messages.appendChild(sysDiv);
-                scrollToBottom();
-                return;
+                if (data.onclick) {
+                    sysDiv.style.cursor = 'pointer';
+                    sysDiv.onclick = data.onclick;
+                }
+                return sysDiv;
             }
 
-            const notifyText = data.type === 'image' ? (data.msg || 'sent an image') : data.msg;
-            notifyUser(data.username, notifyText);
-
             const row = document.createElement("div");
             row.className = `message-row ${isMe ? 'self' : 'other'}`;
+            if (data.type === 'private') row.classList.add('private');
 
             const bubble = document.createElement("div");
             bubble.className = "message-bubble";
 
             if (data.type === 'image') {
-                const img = document.createElement("img");
-                img.src = data.url;
-                img.className = "chat-image";
-                img.onclick = () => window.open(data.url, '_blank');
-                bubble.appendChild(img);
+                bubble.appendChild(data.expired ? expiredPlaceholder() : renderImage(data));
                 if (data.msg) {
                     const caption = document.createElement("div");
                     caption.innerText = data.msg;
@@ -556,6 +1471,7 @@ def index():
             
             const nameSpan = document.createElement("span");
             nameSpan.innerText = isMe ? "You" : data.username;
+            if (data.type === 'private') nameSpan.innerText += isMe ? ` → ${data.to}` : ' → you';
             nameSpan.style.fontWeight = "600";
             
             const timeSpan = document.createElement("span");
@@ -571,18 +1487,124 @@ def index():
 
             row.appendChild(bubble);
             row.appendChild(meta);
-            messages.appendChild(row);
-            scrollToBottom();
+            return row;
+        }
+
+        function expiredPlaceholder() {
+            const div = document.createElement("div");
+            div.className = "media-expired";
+            div.innerText = "Media expired";
+            return div;
+        }
+
+        function renderImage(data) {
+            const img = document.createElement("img");
+            const media = data.media || {};
+            // Show the resized preview, the original only loads when clicked
+            img.src = media.animated || media.preview || data.url;
+            img.onerror = () => {
+                if (media.animated && img.src.endsWith(media.animated)) {
+                    // Fall back to the GIF where animated WebP isn't supported
+                    img.src = data.url;
+                } else if (data.url.startsWith('/media/')) {
+                    // Removed from the media store since the message arrived
+                    img.onerror = null;
+                    img.replaceWith(expiredPlaceholder());
+                }
+            };
+            if (media.preview && media.display) {
+                img.srcset = `${media.preview} 480w, ${media.display} 1280w`;
+                img.sizes = '(max-width: 740px) 65vw, 480px';
+            }
+            img.className = "chat-image";
+            // Only fetched and decoded once it is about to scroll into view
+            img.loading = 'lazy';
+            img.decoding = 'async';
+            if (media.width && media.height) {
+                // Reserve the space it will take, at the width it is shown at
+                const width = Math.min(media.width, 480);
+                img.width = width;
+                img.height = Math.round(width * media.height / media.width);
+            }
+            if (media.placeholder) {
+                img.classList.add('placeholder');
+                img.style.backgroundImage = `url(${media.placeholder})`;
+                img.addEventListener('load', () => {
+                    img.classList.remove('placeholder');
+                    img.style.backgroundImage = '';
+                }, { once: true });
+            }
+            img.onclick = () => window.open(data.url, '_blank');
+            return img;
+        }
+
+        // --- Scroll-back ---
+        // Older history is fetched a page at a time when the user reaches the top
+        let oldestId = null;
+        let hasMoreHistory = false;
+        // Newest message id on screen, sent on reconnect to get just the delta
+        let lastSeenId = null;
+        let loadingHistory = false;
+
+        function prependMessages(list) {
+            const blocks = [];
+            for (let i = 0; i < list.length; i += MESSAGE_BLOCK_SIZE) {
+                const block = createBlock(list.slice(i, i + MESSAGE_BLOCK_SIZE));
+                block.classList.add('settled');
+                blocks.push(block);
+            }
+            const previousHeight = messages.scrollHeight;
+            messages.style.scrollBehavior = 'auto';
+            messages.prepend(...blocks);
+            messages.scrollTop += messages.scrollHeight - previousHeight;
+            messages.style.scrollBehavior = '';
+            blocks.forEach(block => blockObserver.observe(block));
+        }
+
+        function loadOlderMessages() {
+            if (loadingHistory || !hasMoreHistory || oldestId === null) return;
+            loadingHistory = true;
+            socket.emit('history', { before: oldestId, channel: currentChannel }, (page) => {
+                loadingHistory = false;
+                if (page.channel !== currentChannel) return;
+                hasMoreHistory = page.has_more;
+                if (page.messages.length) {
+                    oldestId = page.messages[0].id;
+                    prependMessages(page.messages);
+                }
+            });
+        }
+
+        messages.addEventListener('scroll', () => {
+            if (messages.scrollTop < 50) loadOlderMessages();
+        });
+
+        // "/msg name text" goes privately to every tab that user has open. Names
+        // with spaces are quoted: /msg "bob smith" text
+        const DM_RE = /^\\/msg\\s+(?:"((?:[^"\\\\]|\\\\.)*)"|(\\S+))\\s+([\\s\\S]+)$/;
+
+        function dmTarget(name) {
+            return /^$|[\\s"\\\\]/.test(name) ? '"' + name.replace(/["\\\\]/g, '\\\\$&') + '"' : name;
         }
 
         function sendMessage() {
             const msg = input.value.trim();
             const user = usernameInput.value.trim() || "Anon";
             const imageUrl = document.getElementById('imageUrl').value.trim(); 
+
+            const dm = !imageUrl && msg.match(DM_RE);
+            if (dm) {
+                // Quoted names may escape quotes and backslashes
+                const to = dm[1] !== undefined ? dm[1].replace(/\\\\(.)/g, '$1') : dm[2];
+                emitPacket("private_message", { username: user, to: to, msg: dm[3] });
+                input.value = "";
+                input.focus();
+                return;
+            }
             
             if (msg || imageUrl) {
                 localStorage.setItem('chat_username', user);
-                const data = {username: user};
+                const data = {username: user, channel: currentChannel};
                 if (imageUrl) {
                     data.type = 'image';
                     data.url = imageUrl;
@@ -591,7 +1613,7 @@ def index():
                     data.type = 'text';
                     data.msg = msg;
                 }
-                socket.emit("message", data);
+                emitPacket("message", data);
                 input.value = "";
                 document.getElementById('imageUrl').value = "";
                 input.focus();
@@ -633,22 +1655,149 @@ def index():
         }
 
         function handleFile(file) {
-            const reader = new FileReader();
-            reader.onload = () => sendImage(reader.result);
-            reader.readAsDataURL(file);
+            shrinkImage(file)
+                .then(blob => {
+                    // Small images ride along with the message as a binary attachment
+                    if (binaryPackets && blob.size <= UPLOAD_CONFIG.chunk_size) return sendImageBytes(blob);
+                    return uploadFile(blob).then(sendImage);
+                })
+                .catch(e => console.log("Upload failed", e));
+        }
+
+        // --- Pre-upload downscaling, settings come from the server ---
+        const UPLOAD_CONFIG = {{ upload_config|tojson }};
+
+        function isAnimated(file) {
+            if (file.type === 'image/gif') return Promise.resolve(true);
+            if (file.type !== 'image/png' && file.type !== 'image/webp') return Promise.resolve(false);
+            // APNG has an acTL chunk and animated WebP an ANIM chunk near the start of the file
+            return file.slice(0, 4096).arrayBuffer().then(buffer => {
+                const head = String.fromCharCode(...new Uint8Array(buffer));
+                return head.includes('acTL') || head.includes('ANIM');
+            });
+        }
+
+        function encodeCanvas(canvas, type, quality) {
+            return new Promise(resolve => canvas.toBlob(resolve, type, quality));
+        }
+
+        function shrinkImage(file) {
+            if (!window.createImageBitmap) return Promise.resolve(file);
+            return isAnimated(file).then(animated => {
+                if (animated) return file;
+                return createImageBitmap(file).then(bitmap => {
+                    const scale = Math.min(1, UPLOAD_CONFIG.max_edge / Math.max(bitmap.width, bitmap.height));
+                    const canvas = document.createElement('canvas');
+                    canvas.width = Math.round(bitmap.width * scale);
+                    canvas.height = Math.round(bitmap.height * scale);
+                    canvas.getContext('2d').drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+                    bitmap.close();
+                    return encodeCanvas(canvas, UPLOAD_CONFIG.type, UPLOAD_CONFIG.quality);
+                }).then(blob => {
+                    // Browsers that can't encode the format fall back to PNG, which is rarely smaller
+                    if (!blob || blob.type !== UPLOAD_CONFIG.type || blob.size >= file.size) return file;
+                    return blob;
+                });
+            }).catch(() => file);
+        }
+
+        function uploadFile(blob) {
+            if (blob.size > UPLOAD_CONFIG.chunk_size) return uploadChunked(blob);
+            return fetch('/upload', { method: 'POST', body: blob })
+                .then(res => res.json())
+                .then(res => {
+                    if (res.error) throw new Error(res.error);
+                    return res.url;
+                });
+        }
+
+        // --- Resumable chunked uploads ---
+        const UPLOAD_MAX_RETRIES = 10;
+        const SHA256_SLICE_SIZE = 4 * 1024 * 1024;
+
+        function sleep(ms) {
+            return new Promise(resolve => setTimeout(resolve, ms));
+        }
+
+        async function sha256Hex(blob) {
+            if (window.crypto && crypto.subtle) {
+                const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+                return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+            }
+            // crypto.subtle only exists on https/localhost, plain-HTTP pages hash it slice by slice
+            const hash = sha256.create();
+            for (let offset = 0; offset < blob.size; offset += SHA256_SLICE_SIZE) {
+                hash.update(new Uint8Array(await blob.slice(offset, offset + SHA256_SLICE_SIZE).arrayBuffer()));
+            }
+            return hash.hex();
+        }
+
+        async function postJSON(url, body) {
+            const res = await fetch(url, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(body)
+            });
+            return res.json();
+        }
+
+        async function uploadChunked(blob) {
+            const upload = await postJSON('/uploads', { size: blob.size, sha256: await sha256Hex(blob) });
+            if (upload.error) throw new Error(upload.error);
+            let offset = 0;
+            let failures = 0;
+            while (offset < blob.size) {
+                try {
+                    const chunk = blob.slice(offset, offset + UPLOAD_CONFIG.chunk_size);
+                    const res = await fetch(`/uploads/${upload.id}?offset=${offset}`, { method: 'PUT', body: chunk });
+                    const status = await res.json();
+                    if (status.offset === undefined) throw new Error(status.error);
+                    offset = status.offset;
+                    failures = 0;
+                } catch (e) {
+                    if (++failures > UPLOAD_MAX_RETRIES) throw e;
+                    await sleep(1000 * failures);
+                    // Ask the server how much arrived before the connection dropped
+                    const status = await fetch(`/uploads/${upload.id}`).then(res => res.json()).catch(() => null);
+                    if (status) offset = status.offset;
+                }
+            }
+            const res = await postJSON(`/uploads/${upload.id}/finish`, {});
+            if (res.error) throw new Error(res.error);
+            return res.url;
         }
 
         function sendImage(url) {
+            // Pasted images can still arrive as data URLs, upload them instead of inlining
+            if (url.startsWith('data:')) {
+                fetch(url).then(res => res.blob()).then(handleFile);
+                return;
+            }
             const user = usernameInput.value.trim() || "Anon";
             localStorage.setItem('chat_username', user);
-            socket.emit("message", {
+            emitPacket("message", {
                 username: user,
+                channel: currentChannel,
                 type: 'image',
                 url: url,
                 msg: ''
             });
         }
 
+        function sendImageBytes(blob) {
+            return blob.arrayBuffer().then(buffer => {
+                const user = usernameInput.value.trim() || "Anon";
+                localStorage.setItem('chat_username', user);
+                emitPacket("message", {
+                    username: user,
+                    channel: currentChannel,
+                    type: 'image',
+                    data: new Uint8Array(buffer),
+                    msg: ''
+                });
+            });
+        }
+
         document.addEventListener('paste', (e) => handleMediaInput(e, e.clipboardData));
         document.addEventListener('dragover', (e) => e.preventDefault());
         document.addEventListener('drop', (e) => {
@@ -657,64 +1806,1271 @@ def index():
         });
 
         // --- Socket Events ---
-        socket.on("connect", () => {
-            const user = usernameInput.value || "Anon";
-            socket.emit('register', user);
-        });
+        socket.on("connect", () => register());
 
         socket.on("disconnect", () => {
+            registered = false;
             document.getElementById('onlineStatus').innerText = "Offline";
             document.getElementById('onlineStatus').style.color = "#ef4444";
         });
 
-        socket.on("message", (data) => addMessage(data));
+        onPacket("message", (data) => {
+            if (data.channel === currentChannel) addMessage(data);
+        });
+
+        onPacket("private_message", (data) => addMessage(data));
+
+        onPacket("message_error", (data) => {
+            const reasons = {
+                too_large: 'it is too large',
+                not_joined: 'you are not in this channel yet',
+                no_such_user: 'nobody by that name is online'
+            };
+            const reason = reasons[data.error]
+                || `you are sending too fast. Try again in ${Math.ceil(data.retry_after)}s`;
+            addMessage({ type: 'system', msg: `Message not sent, ${reason}.` });
+        });
+
+        // The server skipped messages because we couldn't keep up
+        onPacket("missed", (data) => {
+            addMessage({
+                type: 'system',
+                msg: `${data.count} missed messages, click to reload`,
+                // There is a gap before the newest messages, so only a full reload fills it
+                onclick: () => register(true)
+            });
+        });
+
+        // A batch of new messages sent together during a burst, what we missed
+        // while disconnected, or history replayed after we register or join
+        onPacket("messages", (page) => {
+            if (page.channel !== currentChannel) return;
+            if (page.live || page.since !== undefined) {
+                // The rest is still on screen
+                appendMessages(page.messages, !page.live);
+                return;
+            }
+            clearMessages();
+            lastSeenId = null;
+            appendMessages(page.messages, true);
+            oldestId = page.messages.length ? page.messages[0].id : null;
+            hasMoreHistory = page.has_more;
+        });
+
+        // --- Channels ---
+        const CHANNEL_RE = /^[\\w-]{1,32}$/;
+        const channelInput = document.getElementById('channel');
+        let currentChannel = localStorage.getItem('chat_channel') || 'general';
+        channelInput.value = currentChannel;
+
+        function switchChannel(name) {
+            name = name.trim().replace(/^#/, '');
+            if (!CHANNEL_RE.test(name) || name === currentChannel) {
+                channelInput.value = currentChannel;
+                return;
+            }
+            socket.emit('leave', { channel: currentChannel });
+            currentChannel = name;
+            localStorage.setItem('chat_channel', name);
+            clearMessages();
+            oldestId = null;
+            lastSeenId = null;
+            hasMoreHistory = false;
+            onlineUsers = new Set();
+            socket.emit('join', { channel: name });
+        }
+
+        channelInput.addEventListener('keydown', (e) => {
+            if (e.key === 'Enter') {
+                switchChannel(channelInput.value);
+                input.focus();
+            }
+        });
+        channelInput.addEventListener('blur', () => { channelInput.value = currentChannel; });
+
+        // --- Presence ---
+        // The server sends the full roster once, then only join/leave/rename deltas
+        let onlineUsers = new Set();
 
-        socket.on("user_list", (data) => {
-            document.getElementById('onlineStatus').innerText = `${data.count} Online`;
+        function renderUserList(count) {
+            document.getElementById('onlineStatus').innerText = `${count} Online`;
             document.getElementById('onlineStatus').style.color = "";
             
             const list = document.getElementById('userListDisplay');
             list.innerHTML = '<div class="tooltip-header">Active Users</div>';
-            data.users.forEach(user => {
+            onlineUsers.forEach(user => {
                 const div = document.createElement("div");
                 div.className = "user-item";
                 div.innerText = user;
+                div.title = `Message ${user} privately`;
+                div.onclick = () => {
+                    input.value = `/msg ${dmTarget(user)} `;
+                    input.focus();
+                };
                 list.appendChild(div);
             });
+        }
+
+        onPacket("user_list", (data) => {
+            if (data.channel !== currentChannel) return;
+            onlineUsers = new Set(data.users);
+            renderUserList(data.count);
+        });
+
+        onPacket("presence", (delta) => {
+            if (delta.channel !== currentChannel) return;
+            delta.left.forEach(user => onlineUsers.delete(user));
+            delta.renamed.forEach(([oldName, newName]) => {
+                onlineUsers.delete(oldName);
+                onlineUsers.add(newName);
+            });
+            delta.joined.forEach(user => onlineUsers.add(user));
+            renderUserList(delta.count);
         });
     </script>
 </body>
 </html>
-    """)
+"""
+
+def build_page():
+    # The page has no per-request state, so it is rendered and compressed once
+    with app.app_context():
+        html = render_template_string(INDEX_TEMPLATE, asset=asset,
+                                      upload_config=CLIENT_UPLOAD_CONFIG).encode('utf-8')
+    return compress_variants(html, hashlib.sha256(html).hexdigest()[:32], 'text/html')
+
+PAGE = build_page()
+
+@app.route('/')
+def index():
+    response = encoded_response(PAGE, 'text/html')
+    # The page always revalidates so a restart with a new page shows up,
+    # but revalidating is just a 304 thanks to the ETag
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/upload', methods=['POST'])
+def upload():
+    try:
+        sha, mimetype = store_media(read_stream(request.stream))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'hash': sha, 'type': mimetype, 'url': media_url(sha),
+                    'media': media_info(media_url(sha))})
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    expire_uploads()
+    info = request.get_json(silent=True) or {}
+    size = info.get('size')
+    sha = info.get('sha256')
+    if not isinstance(size, int) or not 0 < size <= MAX_CHUNKED_UPLOAD_SIZE:
+        return jsonify({'error': 'Invalid size'}), 400
+    if not isinstance(sha, str) or not HASH_RE.match(sha):
+        return jsonify({'error': 'Invalid hash'}), 400
+    upload_id = uuid.uuid4().hex
+    open(upload_path(upload_id), 'wb').close()
+    UPLOADS[upload_id] = {'size': size, 'sha256': sha, 'updated': time.monotonic(),
+                          'lock': eventlet.semaphore.Semaphore()}
+    return jsonify({'id': upload_id, 'offset': 0})
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    upload = UPLOADS.get(upload_id)
+    if upload is None:
+        abort(404)
+    return jsonify({'id': upload_id, 'offset': upload_offset(upload_id), 'size': upload['size']})
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    upload = UPLOADS.get(upload_id)
+    if upload is None:
+        abort(404)
+    # A retried chunk can arrive while the original is still being written,
+    # it waits and then finds the offset has moved on
+    with upload['lock']:
+        offset = upload_offset(upload_id)
+        # The client must continue exactly where the file ends, otherwise it is told where that is
+        if request.args.get('offset', type=int) != offset:
+            return jsonify({'error': 'Offset mismatch', 'offset': offset}), 409
+        length = request.content_length or 0
+        if length > MAX_CHUNK_SIZE or offset + length > upload['size']:
+            return jsonify({'error': 'Chunk too large', 'offset': offset}), 400
+        with open(upload_path(upload_id), 'ab') as f:
+            for chunk in read_stream(request.stream, length):
+                f.write(chunk)
+        upload['updated'] = time.monotonic()
+        return jsonify({'id': upload_id, 'offset': upload_offset(upload_id)})
+
+@app.route('/uploads/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    upload = UPLOADS.get(upload_id)
+    if upload is None:
+        abort(404)
+    offset = upload_offset(upload_id)
+    if offset != upload['size']:
+        return jsonify({'error': 'Upload incomplete', 'offset': offset}), 409
+    del UPLOADS[upload_id]
+    sha, head = tpool.execute(hash_file, upload_path(upload_id))
+    if upload['sha256'] != sha:
+        os.unlink(upload_path(upload_id))
+        return jsonify({'error': 'Hash mismatch'}), 400
+    try:
+        sha, mimetype = commit_media(upload_path(upload_id), sha, head)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'hash': sha, 'type': mimetype, 'url': media_url(sha),
+                    'media': media_info(media_url(sha))})
+
+@app.route('/history')
+def history():
+    args = parse_history_args(request.args)
+    if args is None:
+        return jsonify({'error': 'Invalid cursor or channel'}), 400
+    return jsonify(fetch_history(*args))
+
+# Stored media never changes, so it can be cached for as long as the assets
+MEDIA_MAX_AGE = ASSET_MAX_AGE
+# Behind nginx, set this to an internal location aliased to MEDIA_DIR (e.g.
+# /protected-media/) and nginx sends the files itself with sendfile.
+MEDIA_ACCEL_PREFIX = os.environ.get('LANCHAT_MEDIA_ACCEL_PREFIX')
+
+def send_media(name, mimetype):
+    if MEDIA_ACCEL_PREFIX:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = MEDIA_ACCEL_PREFIX + name
+    else:
+        # Handles Range, If-None-Match and If-Modified-Since, and streams the
+        # file in blocks (or through the server's sendfile wrapper if it has one)
+        response = send_file(os.path.join(MEDIA_DIR, name), mimetype=mimetype,
+                             etag=name, conditional=True, max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = MEDIA_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/media/<sha>')
+def media(sha):
+    entry = lookup_media(sha)
+    if entry is None:
+        abort(404)
+    touch_media(sha)
+    return send_media(sha, entry['type'])
+
+@app.route('/media/<sha>/<variant>')
+def media_variant(sha, variant):
+    entry = lookup_media(sha)
+    if entry is None or variant not in entry['variants']:
+        abort(404)
+    touch_media(sha)
+    return send_media('%s-%s' % (sha, variant), 'image/webp')
+
+# --- Metrics ---
+# Plain counters bumped inline on the hot paths. Green threads all run on one
+# OS thread, so none of this needs a lock. /metrics renders it all in the
+# Prometheus text format, per server process.
+HUB_LAG_INTERVAL = 0.5
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=''):
+        prefix = labels + ',' if labels else ''
+        lines = []
+        total = 0
+        for bound, hits in zip(self.buckets + [float('inf')], self.counts):
+            total += hits
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, le, total))
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %r' % (name, suffix, self.sum))
+        lines.append('%s_count%s %d' % (name, suffix, self.count))
+        return lines
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+# Chat messages accepted by this process: {type: count}
+MESSAGE_COUNTS = Counter()
+# {'in': bytes of the fields of chat messages received,
+#  'out': engine.io frame bytes of every event pushed to clients}
+# Replies to client calls (register, history, ...) go out through Flask-SocketIO
+# and aren't counted.
+TRAFFIC = Counter()
+HANDLER_LATENCY = {name: Histogram(LATENCY_BUCKETS) for name in ('message', 'register', 'disconnect')}
+# Local recipients per broadcast
+FANOUT_SIZES = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000])
+# How late the hub wakes a green thread that asked to sleep HUB_LAG_INTERVAL
+HUB_LAG = Histogram(LATENCY_BUCKETS)
+
+def timed(handler_name):
+    """Records how long a Socket.IO handler takes in HANDLER_LATENCY."""
+    histogram = HANDLER_LATENCY[handler_name]
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def hub_lag_loop():
+    while True:
+        start = time.monotonic()
+        socketio.sleep(HUB_LAG_INTERVAL)
+        HUB_LAG.observe(max(0.0, time.monotonic() - start - HUB_LAG_INTERVAL))
+
+socketio.start_background_task(hub_lag_loop)
+
+def metric_header(name, kind, description):
+    return ['# HELP %s %s' % (name, description), '# TYPE %s %s' % (name, kind)]
+
+def render_metrics():
+    lines = metric_header('lanchat_sessions', 'gauge',
+                          'Connected sessions, on this process or on all processes sharing the bus.')
+    lines.append('lanchat_sessions{scope="process"} %d' % len(OUTBOX))
+    lines.append('lanchat_sessions{scope="all"} %d' % len(CONNECTED_USERS))
+    lines += metric_header('lanchat_users', 'gauge', 'Distinct usernames connected.')
+    lines.append('lanchat_users %d' % len(USER_SIDS))
+    lines += metric_header('lanchat_channels', 'gauge', 'Channels with at least one member.')
+    lines.append('lanchat_channels %d' % len(CHANNEL_SESSIONS))
+    lines += metric_header('lanchat_backlogged_clients', 'gauge',
+                           'Clients on this process with messages waiting in their outbound queue.')
+    lines.append('lanchat_backlogged_clients %d' % len(BACKLOGGED))
+    lines += metric_header('lanchat_media_bytes', 'gauge', 'Size of the media store, variants included.')
+    lines.append('lanchat_media_bytes %d' % MEDIA_SIZE)
+    lines += metric_header('lanchat_messages_total', 'counter', 'Chat messages accepted by this process.')
+    lines += ['lanchat_messages_total{type="%s"} %d' % (kind, MESSAGE_COUNTS[kind])
+              for kind in ('text', 'image', 'private')]
+    lines += metric_header('lanchat_received_payload_bytes_total', 'counter',
+                           'Bytes of the text and binary fields of chat messages received.')
+    lines.append('lanchat_received_payload_bytes_total %d' % TRAFFIC['in'])
+    lines += metric_header('lanchat_sent_frame_bytes_total', 'counter',
+                           'Engine.IO frame bytes of events pushed to clients, replies to calls excluded.')
+    lines.append('lanchat_sent_frame_bytes_total %d' % TRAFFIC['out'])
+    lines += metric_header('lanchat_broadcasts_total', 'counter', 'Events sent to a group of clients.')
+    lines.append('lanchat_broadcasts_total %d' % FANOUT_STATS['broadcasts'])
+    lines += metric_header('lanchat_broadcast_serializations_total', 'counter',
+                           'Socket.IO serializations of broadcasts, one per packet encoding in use.')
+    lines.append('lanchat_broadcast_serializations_total %d' % FANOUT_STATS['serializations'])
+    lines += metric_header('lanchat_broadcast_frames_total', 'counter',
+                           'Engine.IO frames built for broadcasts, one per encoding and transport in use.')
+    lines.append('lanchat_broadcast_frames_total %d' % FANOUT_STATS['frames'])
+    lines += metric_header('lanchat_broadcast_recipients', 'histogram',
+                           'Clients on this process reached by each broadcast.')
+    lines += FANOUT_SIZES.render('lanchat_broadcast_recipients')
+    lines += metric_header('lanchat_handler_seconds', 'histogram', 'Time spent in Socket.IO handlers.')
+    for name, histogram in HANDLER_LATENCY.items():
+        lines += histogram.render('lanchat_handler_seconds', 'handler="%s"' % name)
+    lines += metric_header('lanchat_hub_lag_seconds', 'histogram',
+                           'How late the eventlet hub wakes a sleeping green thread.')
+    lines += HUB_LAG.render('lanchat_hub_lag_seconds')
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 # --- SocketIO Handlers ---
 
 @socketio.on('connect')
 def handle_connect():
-    pass
+    OUTBOX[request.sid] = ClientQueue(request.sid)
 
 @socketio.on('disconnect')
+@timed('disconnect')
 def handle_disconnect():
-    if request.sid in CONNECTED_USERS:
-        del CONNECTED_USERS[request.sid]
-    broadcast_user_list()
+    RATE_LIMITERS.pop(request.sid, None)
+    OUTBOX.pop(request.sid, None)
+    BACKLOGGED.discard(request.sid)
+    SESSION_ENCODINGS.pop(request.sid, None)
+    remove_session(request.sid)
 
 @socketio.on('register')
-def handle_register(username):
-    CONNECTED_USERS[request.sid] = username
-    broadcast_user_list()
+@timed('register')
+def handle_register(username, options=None):
+    if not isinstance(username, str):
+        return {'error': 'invalid_username'}
+    options = options if isinstance(options, dict) else {}
+    encoding = set_encoding(request.sid, options.get('encoding'))
+    set_username(request.sid, username)
+    # Older pages don't know about channels and only ever see the default one
+    channels = options.get('channels')
+    if not isinstance(channels, list) or not channels:
+        channels = [DEFAULT_CHANNEL]
+    channels = list(dict.fromkeys(c for c in channels if valid_channel(c)))[:MAX_CHANNELS_PER_SESSION]
+    # Reconnecting clients send the last message id they saw per channel
+    since = options.get('since') if isinstance(options.get('since'), dict) else {}
+    for channel in session_channels(request.sid) - set(channels):
+        leave_channel(request.sid, channel)
+    for channel in channels:
+        join_channel(request.sid, channel)
+        last_seen = since.get(channel)
+        send_channel_state(request.sid, channel,
+                           last_seen if isinstance(last_seen, int) and last_seen >= 0 else None)
+    return {'encoding': encoding, 'channels': channels}
+
+@socketio.on('join')
+def handle_join(data):
+    channel = data.get('channel') if isinstance(data, dict) else None
+    if not valid_channel(channel):
+        return {'error': 'invalid_channel'}
+    joined = session_channels(request.sid)
+    if channel not in joined and len(joined) >= MAX_CHANNELS_PER_SESSION:
+        return {'error': 'too_many_channels'}
+    join_channel(request.sid, channel)
+    send_channel_state(request.sid, channel)
+    return {'channel': channel}
+
+@socketio.on('leave')
+def handle_leave(data):
+    channel = data.get('channel') if isinstance(data, dict) else None
+    if valid_channel(channel):
+        leave_channel(request.sid, channel)
+
+@socketio.on('history')
+def handle_history(data):
+    args = parse_history_args(data if isinstance(data, dict) else {})
+    if args is None:
+        return {'messages': [], 'has_more': False}
+    return dict(fetch_history(*args), channel=args[2])
+
+# What clients may send with each event. Anything else is dropped, so only
+# plain, JSON-safe values ever reach the bus.
+MESSAGE_FIELDS = {'username': str, 'channel': str, 'type': str, 'msg': str, 'url': str,
+                  'data': bytes}
+PRIVATE_MESSAGE_FIELDS = {'username': str, 'to': str, 'msg': str}
+
+def clean_packet(data, fields):
+    """Returns the known fields of a client payload, or None if it's malformed."""
+    if not isinstance(data, dict) or not isinstance(data.get('username'), str):
+        return None
+    cleaned = {}
+    for field, kind in fields.items():
+        value = data.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, kind):
+            return None
+        cleaned[field] = value
+    return cleaned
 
 @socketio.on('message')
+@timed('message')
 def handle_message(data):
-    CONNECTED_USERS[request.sid] = data['username']
+    data = clean_packet(decode_packet(data), MESSAGE_FIELDS)
+    if data is None or data.get('type') not in ('text', 'image'):
+        return
+    TRAFFIC['in'] += payload_size(data)
+    set_username(request.sid, data['username'])
+    channel = data.get('channel') or DEFAULT_CHANNEL
+    # A join still on its way to the hub counts, it gets there before this message
+    if channel not in session_channels(request.sid):
+        emit_to(request.sid, 'message_error', {'error': 'not_joined', 'type': data.get('type')})
+        return
+    data['channel'] = channel
+    if rate_limited(request.sid, data):
+        return
+    if data.get('type') == 'image' and DATA_URL_RE.match(data.get('url', '')):
+        try:
+            data['url'] = store_data_url(data['url'])
+        except ValueError:
+            return
+    # Binary clients attach small images as raw bytes instead of uploading them
+    image = data.pop('data', None)
+    if data.get('type') == 'image' and isinstance(image, bytes):
+        try:
+            sha, _ = store_media([image])
+        except ValueError:
+            return
+        data['url'] = media_url(sha)
+    if data.get('type') == 'image':
+        data['media'] = media_info(data.get('url', ''))
     data['timestamp'] = datetime.now().strftime('%H:%M')
-    emit('message', data, broadcast=True)
-    broadcast_user_list()
-
-def broadcast_user_list():
-    users = list(set(CONNECTED_USERS.values())) 
-    emit('user_list', {'count': len(CONNECTED_USERS), 'users': users}, broadcast=True)
+    BUS.publish('message', data)
+    MESSAGE_COUNTS['image' if data.get('type') == 'image' else 'text'] += 1
+
+@socketio.on('private_message')
+def handle_private_message(data):
+    data = clean_packet(decode_packet(data), PRIVATE_MESSAGE_FIELDS)
+    if data is None or not data.get('msg'):
+        return
+    TRAFFIC['in'] += payload_size(data)
+    set_username(request.sid, data['username'])
+    target = data.get('to')
+    if target not in USER_SIDS:
+        emit_to(request.sid, 'message_error', {'error': 'no_such_user', 'type': 'private'})
+        return
+    data['type'] = 'private'
+    if rate_limited(request.sid, data):
+        return
+    # Private messages aren't stored, they only reach the sessions open right now
+    BUS.publish('private_message', {'username': data['username'], 'to': target, 'type': 'private',
+                                    'msg': data['msg'],
+                                    'timestamp': datetime.now().strftime('%H:%M')})
+    MESSAGE_COUNTS['private'] += 1
+
+# --- Rate Limiting ---
+# Token buckets per session, counting both messages and bytes, with separate
+# budgets per message type: {type: {'messages': (per second, burst), 'bytes': (...)}}
+RATE_LIMITS = {
+    'text': {'messages': (5, 10), 'bytes': (16 * 1024, 64 * 1024)},
+    # The burst has room for the largest file a chunked upload accepts
+    'image': {'messages': (0.5, 4), 'bytes': (1024 * 1024, MAX_CHUNKED_UPLOAD_SIZE)},
+}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available, 0 if they are now."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if amount <= self.tokens:
+            return 0
+        if amount > self.capacity:
+            return float('inf')
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+# {session_id: {type: (message bucket, byte bucket)}}
+RATE_LIMITERS = {}
+
+def message_cost(data):
+    # An image costs what every recipient has to download, not just its URL
+    url = data.get('url') or ''
+    if data.get('type') == 'image' and url.startswith('/media/'):
+        sha = url[len('/media/'):].split('/', 1)[0]
+        entry = lookup_media(sha) if HASH_RE.match(sha) else None
+        if entry is not None:
+            return shown_size(sha, entry)
+    return payload_size(data)
+
+def shown_size(sha, entry):
+    # Messages show the animated copy or a resized variant, the original only loads when clicked
+    for variant in ('animated', 'display', 'preview'):
+        if variant in entry['variants']:
+            try:
+                return os.path.getsize(media_path(sha, variant))
+            except OSError:
+                pass
+    return entry['size']
+
+def rate_limited(sid, data):
+    """Checks the message against the session's budget, tells the client if it is over."""
+    retry_after = check_rate_limit(sid, data)
+    if retry_after == float('inf'):
+        emit_to(sid, 'message_error', {'error': 'too_large', 'type': data.get('type')})
+    elif retry_after:
+        emit_to(sid, 'message_error', {'error': 'rate_limited', 'type': data.get('type'),
+                                       'retry_after': round(retry_after, 2)})
+    return bool(retry_after)
+
+def check_rate_limit(sid, data):
+    """Takes tokens for the message, returns seconds to wait if it is over budget."""
+    kind = 'image' if data.get('type') == 'image' else 'text'
+    buckets = RATE_LIMITERS.setdefault(sid, {})
+    if kind not in buckets:
+        limits = RATE_LIMITS[kind]
+        buckets[kind] = (TokenBucket(*limits['messages']), TokenBucket(*limits['bytes']))
+    messages, size = buckets[kind]
+    cost = message_cost(data)
+    retry_after = max(messages.wait_time(1), size.wait_time(cost))
+    if retry_after:
+        return retry_after
+    messages.take(1)
+    size.take(cost)
+    return 0
+
+# --- Binary Packets ---
+# Clients can ask for MessagePack when they register. They then get chat events
+# as one binary attachment instead of JSON text and may send messages, with raw
+# image bytes, the same way. Other clients keep getting JSON.
+PACKET_ENCODINGS = ('json', 'msgpack') if msgpack is not None else ('json',)
+# {session_id: encoding}, sessions not in here use JSON
+SESSION_ENCODINGS = {}
+
+def set_encoding(sid, encoding):
+    """Switches a session to `encoding` if the server supports it, returns the one in use."""
+    if encoding not in PACKET_ENCODINGS or encoding == 'json':
+        SESSION_ENCODINGS.pop(sid, None)
+        return 'json'
+    SESSION_ENCODINGS[sid] = encoding
+    return encoding
+
+def encode_packet(payload, encoding):
+    if encoding == 'msgpack':
+        return msgpack.packb(payload, use_bin_type=True)
+    return payload
+
+def decode_packet(data):
+    if not isinstance(data, bytes) or msgpack is None:
+        return data
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except ValueError:
+        return None
+
+def emit_to(sid, event, payload):
+    send_packet(sid, encode_event(event, payload, SESSION_ENCODINGS.get(sid, 'json')))
+
+# --- Outbound Queues ---
+# Chat messages go through a bounded queue per client. engine.io's own send
+# queue is unbounded, so a client only gets more packets while it has fewer
+# than CLIENT_WIRE_DEPTH waiting there; otherwise they wait in its ClientQueue,
+# and SLOW_CLIENT_POLICY decides what happens once that is full.
+CLIENT_QUEUE_MAX_MESSAGES = 200
+CLIENT_QUEUE_MAX_BYTES = 1024 * 1024
+CLIENT_WIRE_DEPTH = 16
+CLIENT_DRAIN_INTERVAL = 0.05
+# Applied in order while a queue is over its limits:
+#   drop_media - drop queued image messages
+#   collapse   - replace the queue with a single "N missed messages" marker
+#   disconnect - drop clients that stay stalled for SLOW_CLIENT_TIMEOUT seconds
+SLOW_CLIENT_POLICY = ('drop_media', 'collapse', 'disconnect')
+SLOW_CLIENT_TIMEOUT = 30
+
+class ClientQueue:
+    def __init__(self, sid):
+        self.sid = sid
+        self.items = deque()  # (engine.io frames, size, has_media, message count)
+        self.size = 0
+        self.missed = 0
+        self.stalled_since = None
+
+    def over_limit(self):
+        return len(self.items) > CLIENT_QUEUE_MAX_MESSAGES or self.size > CLIENT_QUEUE_MAX_BYTES
+
+    def drop_media(self):
+        kept = deque()
+        for item in self.items:
+            if item[2]:
+                self.size -= item[1]
+                self.missed += item[3]
+            else:
+                kept.append(item)
+        self.items = kept
+
+    def collapse(self):
+        self.missed += sum(item[3] for item in self.items)
+        self.items.clear()
+        self.size = 0
+
+# Queues of the clients connected to this process: {session_id: ClientQueue}
+OUTBOX = {}
+# Session ids whose queue has packets waiting
+BACKLOGGED = set()
+# Messages arriving within this many seconds of each other go out to a channel
+# as one 'messages' batch, one frame and one render per client instead of one
+# per message. 0 sends every message on its own.
+BROADCAST_BATCH_WINDOW = 0.005
+# Messages waiting for the batch window to close: {channel: [message]}
+PENDING_BROADCASTS = {}
+# A broadcast is serialized once per packet encoding in use, and framed once
+# per encoding and engine.io transport, however many clients it reaches:
+# {'broadcasts': n, 'serializations': n, 'frames': n, 'recipients': n}
+FANOUT_STATS = Counter()
+
+def payload_size(payload):
+    return sum(len(value) for value in payload.values() if isinstance(value, (str, bytes)))
+
+def wire_depth(sid):
+    # Packets engine.io has queued for this client but not yet written. engine.io
+    # has no public API for this, it reads the socket's queue (python-engineio 4.x).
+    eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+    eio_socket = socketio.server.eio.sockets.get(eio_sid)
+    return eio_socket.queue.qsize() if eio_socket is not None else 0
+
+def encode_event(event, payload, encoding):
+    """Serializes an event into its Socket.IO wire parts, ready for any client."""
+    pkt = socketio.server.packet_class(sio_packet.EVENT, namespace='/',
+                                       data=[event, encode_packet(payload, encoding)])
+    parts = pkt.encode()
+    return parts if isinstance(parts, list) else [parts]
+
+def build_packet(event, payload, encoding):
+    FANOUT_STATS['serializations'] += 1
+    return encode_event(event, payload, encoding)
+
+def client_transport(sid):
+    eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+    try:
+        return socketio.server.eio.transport(eio_sid)
+    except KeyError:
+        return 'polling'
+
+def build_frames(parts, transport):
+    """Wraps Socket.IO parts in engine.io packets, encoded once for `transport`.
+
+    engine.io keeps the first encoding of a packet, and binary parts are base64
+    text when polling, so frames are only shared by clients on one transport.
+    Clients still upgrading count as polling: base64 also decodes over websocket.
+    """
+    frames = []
+    for part in parts:
+        frame = eio_packet.Packet(eio_packet.MESSAGE, part)
+        frame.encode(b64=transport == 'polling')
+        frames.append(frame)
+    return frames
+
+def send_frames(sid, frames):
+    eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+    if eio_sid is None:
+        return
+    for frame in frames:
+        socketio.server.eio.send_packet(eio_sid, frame)
+        TRAFFIC['out'] += len(frame.encode())
+
+def send_packet(sid, parts):
+    send_frames(sid, build_frames(parts, client_transport(sid)))
+
+def client_frames(packets, sid, event, payload):
+    # `packets` caches the parts per encoding, and their frames per encoding and
+    # transport, for the duration of one broadcast
+    encoding = SESSION_ENCODINGS.get(sid, 'json')
+    key = (encoding, client_transport(sid))
+    if key not in packets:
+        if encoding not in packets:
+            packets[encoding] = build_packet(event, payload, encoding)
+        FANOUT_STATS['frames'] += 1
+        packets[key] = build_frames(packets[encoding], key[1])
+    FANOUT_STATS['recipients'] += 1
+    return packets[key]
+
+def broadcast(event, payload, channel, messages=None):
+    """Sends to the channel's members on this process through their queues."""
+    deliver(event, payload, CHANNEL_SESSIONS.get(channel, ()), messages)
+
+def deliver(event, payload, sids, messages=None):
+    """Sends to those of `sids` connected to this process through their queues.
+
+    `messages` lists the chat messages a batch payload carries, for the queue
+    accounting; by default the payload is a single message.
+    """
+    FANOUT_STATS['broadcasts'] += 1
+    messages = messages or [payload]
+    item = (sum(payload_size(data) for data in messages),
+            any(data.get('type') == 'image' for data in messages),
+            len(messages))
+    packets = {}
+    recipients = 0
+    for sid in list(sids):
+        queue = OUTBOX.get(sid)
+        if queue is not None:
+            enqueue(queue, client_frames(packets, sid, event, payload), *item)
+            recipients += 1
+    FANOUT_SIZES.observe(recipients)
+
+def queue_broadcast(data):
+    if not BROADCAST_BATCH_WINDOW:
+        broadcast('message', data, data['channel'])
+        return
+    pending = PENDING_BROADCASTS.setdefault(data['channel'], [])
+    pending.append(data)
+    if len(pending) == 1:
+        socketio.start_background_task(flush_broadcasts, data['channel'])
+
+def flush_broadcasts(channel):
+    socketio.sleep(BROADCAST_BATCH_WINDOW)
+    batch = PENDING_BROADCASTS.pop(channel, [])
+    if len(batch) == 1:
+        broadcast('message', batch[0], channel)
+    elif batch:
+        broadcast('messages', {'channel': channel, 'messages': batch, 'live': True},
+                  channel, batch)
+
+def emit_channel(event, payload, channel):
+    """Sends to the channel's members on this process right away, for small state updates."""
+    FANOUT_STATS['broadcasts'] += 1
+    packets = {}
+    recipients = 0
+    for sid in list(CHANNEL_SESSIONS.get(channel, ())):
+        if sid in OUTBOX:
+            send_frames(sid, client_frames(packets, sid, event, payload))
+            recipients += 1
+    FANOUT_SIZES.observe(recipients)
+
+def enqueue(queue, frames, size, has_media, message_count):
+    if not queue.items and not queue.missed and wire_depth(queue.sid) < CLIENT_WIRE_DEPTH:
+        send_frames(queue.sid, frames)
+        return
+    queue.items.append((frames, size, has_media, message_count))
+    queue.size += size
+    if queue.sid not in BACKLOGGED:
+        BACKLOGGED.add(queue.sid)
+        queue.stalled_since = time.monotonic()
+    if queue.over_limit() and 'drop_media' in SLOW_CLIENT_POLICY:
+        queue.drop_media()
+    if queue.over_limit() and 'collapse' in SLOW_CLIENT_POLICY:
+        queue.collapse()
+    if queue.over_limit():
+        # No policy left to make room, the oldest messages have to go
+        while queue.over_limit():
+            _, size, _, message_count = queue.items.popleft()
+            queue.size -= size
+            queue.missed += message_count
+
+def drain_queue(queue):
+    """Sends queued packets while the client keeps up, returns True once empty."""
+    sent = False
+    if queue.missed and wire_depth(queue.sid) < CLIENT_WIRE_DEPTH:
+        emit_to(queue.sid, 'missed', {'count': queue.missed})
+        queue.missed = 0
+        sent = True
+    while queue.items and not queue.missed and wire_depth(queue.sid) < CLIENT_WIRE_DEPTH:
+        frames, size, _, _ = queue.items.popleft()
+        queue.size -= size
+        send_frames(queue.sid, frames)
+        sent = True
+    if sent:
+        # A client that is behind but still taking packets isn't stalled
+        queue.stalled_since = time.monotonic()
+    return not queue.items and not queue.missed
+
+def drain_loop():
+    while True:
+        socketio.sleep(CLIENT_DRAIN_INTERVAL)
+        now = time.monotonic()
+        for sid in list(BACKLOGGED):
+            queue = OUTBOX.get(sid)
+            if queue is None or drain_queue(queue):
+                BACKLOGGED.discard(sid)
+            elif ('disconnect' in SLOW_CLIENT_POLICY
+                  and now - queue.stalled_since > SLOW_CLIENT_TIMEOUT):
+                BACKLOGGED.discard(sid)
+                OUTBOX.pop(sid, None)
+                socketio.server.disconnect(sid)
+
+socketio.start_background_task(drain_loop)
+
+# --- Presence ---
+
+# State of each channel as of its last presence broadcast, deltas are computed
+# against it: {'channels': {channel: (users, count)}, 'dirty': set(channel), ...}
+PRESENCE = {'channels': {}, 'dirty': set(), 'renames': [], 'scheduled': False}
+
+def set_username(sid, username):
+    if CONNECTED_USERS.get(sid) != username:
+        BUS.publish('session', {'sid': sid, 'username': username, 'worker': WORKER_ID})
+
+def remove_session(sid):
+    # A session can join channels without ever registering a name
+    if sid in CONNECTED_USERS or session_channels(sid):
+        BUS.publish('session_end', {'sid': sid})
+    PENDING_JOINS.pop(sid, None)
+
+def add_session(sid, username, worker):
+    old = CONNECTED_USERS.get(sid)
+    if old == username:
+        return
+    if old is not None:
+        release_username(sid, old)
+        PRESENCE['renames'].append((old, username))
+    CONNECTED_USERS[sid] = username
+    USER_SIDS.setdefault(username, set()).add(sid)
+    WORKER_SESSIONS.setdefault(worker, set()).add(sid)
+    for channel in SESSION_CHANNELS.get(sid, ()):
+        mark_presence(channel)
+
+def drop_session(sid):
+    for channel in list(SESSION_CHANNELS.get(sid, ())):
+        drop_member(sid, channel)
+    username = CONNECTED_USERS.pop(sid, None)
+    if username is not None:
+        for sids in WORKER_SESSIONS.values():
+            sids.discard(sid)
+        release_username(sid, username)
+
+def release_username(sid, username):
+    sids = USER_SIDS.get(username)
+    if sids is not None:
+        sids.discard(sid)
+        if not sids:
+            del USER_SIDS[username]
+
+def mark_presence(channel):
+    PRESENCE['dirty'].add(channel)
+    if not PRESENCE['scheduled']:
+        PRESENCE['scheduled'] = True
+        socketio.start_background_task(flush_presence)
+
+def channel_users(channel):
+    members = CHANNEL_SESSIONS.get(channel, ())
+    return {CONNECTED_USERS[sid] for sid in members if sid in CONNECTED_USERS}, len(members)
+
+def channel_roster(channel):
+    users, count = channel_users(channel)
+    return {'channel': channel, 'count': count, 'users': list(users)}
+
+def flush_presence():
+    socketio.sleep(PRESENCE_INTERVAL)
+    PRESENCE['scheduled'] = False
+    dirty, PRESENCE['dirty'] = PRESENCE['dirty'], set()
+    renames, PRESENCE['renames'] = PRESENCE['renames'], []
+    for channel in dirty:
+        users, count = channel_users(channel)
+        before, before_count = PRESENCE['channels'].get(channel, (set(), 0))
+        joined = users - before
+        left = before - users
+        renamed = []
+        for old, new in renames:
+            if old in left and new in joined:
+                left.discard(old)
+                joined.discard(new)
+                renamed.append([old, new])
+        if not (joined or left or renamed) and count == before_count:
+            continue
+        if count:
+            PRESENCE['channels'][channel] = (users, count)
+        else:
+            PRESENCE['channels'].pop(channel, None)
+        emit_channel('presence', {'channel': channel, 'count': count, 'joined': list(joined),
+                                  'left': list(left), 'renamed': renamed}, channel)
+
+# --- Channels ---
+# Clients join and leave named channels; messages and presence only go to a
+# channel's members. Membership changes travel over the bus like sessions do.
+
+def valid_channel(channel):
+    return isinstance(channel, str) and CHANNEL_RE.match(channel) is not None
+
+def session_channels(sid):
+    """Channels a session is in, or has asked this process to join."""
+    return SESSION_CHANNELS.get(sid, set()) | PENDING_JOINS.get(sid, set())
+
+def join_channel(sid, channel):
+    if channel not in session_channels(sid):
+        PENDING_JOINS.setdefault(sid, set()).add(channel)
+        BUS.publish('join', {'sid': sid, 'channel': channel})
+
+def leave_channel(sid, channel):
+    if channel in session_channels(sid):
+        BUS.publish('leave', {'sid': sid, 'channel': channel})
+
+def add_member(sid, channel):
+    pending = PENDING_JOINS.get(sid)
+    if pending is not None:
+        pending.discard(channel)
+        if not pending:
+            del PENDING_JOINS[sid]
+    SESSION_CHANNELS.setdefault(sid, set()).add(channel)
+    CHANNEL_SESSIONS.setdefault(channel, set()).add(sid)
+    mark_presence(channel)
+
+def drop_member(sid, channel):
+    channels = SESSION_CHANNELS.get(sid)
+    if channels is None or channel not in channels:
+        return
+    channels.discard(channel)
+    if not channels:
+        del SESSION_CHANNELS[sid]
+    members = CHANNEL_SESSIONS[channel]
+    members.discard(sid)
+    if not members:
+        del CHANNEL_SESSIONS[channel]
+    mark_presence(channel)
+
+def send_channel_state(sid, channel, since=None):
+    # Recent history, or only what it missed if the client says what it saw
+    # last, and the full roster for the joining client. The rest of the
+    # channel only gets a presence delta.
+    page = fetch_since(since, channel) if since is not None else None
+    if page is None:
+        page = fetch_history(sys.maxsize, HISTORY_REPLAY_COUNT, channel)
+    emit_to(sid, 'messages', dict(page, channel=channel))
+    emit_to(sid, 'user_list', channel_roster(channel))
+
+# --- Message Bus ---
+# Chat events are published to a bus and applied by every server process, so
+# several processes (e.g. behind a load balancer with sticky sessions) share one
+# chat. One process, the hub, sees every event first: it assigns message ids
+# and writes the message log.
+WORKER_ID = uuid.uuid4().hex[:8]
+BUS_MAX_FRAME = 16 * 1024 * 1024
+
+def stamp_event(event, payload):
+    # Runs once per event, on the hub, before the event reaches any process
+    if event == 'message':
+        payload['id'] = next(MESSAGE_IDS)
+
+def record_event(event, payload):
+    # Runs once per event, on the hub, once it's known every process can be sent it
+    if event == 'message':
+        log_message(MessageHistory.pack(payload))
+
+def apply_event(event, payload):
+    # Runs in every process, for every event
+    if event == 'message':
+        HISTORY.append(MessageHistory.pack(payload))
+        FIRST_CHANNEL_IDS.setdefault(payload['channel'], payload['id'])
+        queue_broadcast(payload)
+    elif event == 'session':
+        add_session(payload['sid'], payload['username'], payload['worker'])
+    elif event == 'session_end':
+        drop_session(payload['sid'])
+    elif event == 'private_message':
+        # Every tab of the recipient, and the sender's own tabs so they see it too
+        sids = USER_SIDS.get(payload['to'], set()) | USER_SIDS.get(payload['username'], set())
+        deliver('private_message', payload, sids)
+    elif event == 'join':
+        add_member(payload['sid'], payload['channel'])
+    elif event == 'leave':
+        drop_member(payload['sid'], payload['channel'])
+    elif event == 'worker_gone':
+        for sid in list(WORKER_SESSIONS.pop(payload['worker'], ())):
+            drop_session(sid)
+    elif event == 'media_evicted':
+        forget_media(payload['sha'])
+    elif event == 'media_stored':
+        entry = lookup_media(payload['sha'])
+        if entry is not None:
+            entry['stored'] = max(entry['stored'], payload['stored'])
+            mark_accessed(payload['sha'])
+    elif event == 'media_used':
+        for sha in payload['shas']:
+            if lookup_media(sha) is not None:
+                mark_accessed(sha)
+    elif event == 'sync':
+        for sid, username, worker, channels in payload['sessions']:
+            add_session(sid, username, worker)
+            for channel in channels:
+                add_member(sid, channel)
+
+def become_hub():
+    global MESSAGE_IDS
+    # Another process may have been the hub until now, continue after its last id
+    newest = HISTORY.entries[-1][0] if HISTORY.entries else 0
+    logged = DB.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0
+    MESSAGE_IDS = count(max(newest, logged) + 1)
+
+def roster_snapshot():
+    return {'sessions': [[sid, CONNECTED_USERS[sid], worker, list(SESSION_CHANNELS.get(sid, ()))]
+                         for worker, sids in WORKER_SESSIONS.items() for sid in sids]}
+
+def local_sessions():
+    return [[sid, CONNECTED_USERS[sid], list(SESSION_CHANNELS.get(sid, ()))]
+            for sid in WORKER_SESSIONS.get(WORKER_ID, ())]
+
+def forget_remote_sessions():
+    for worker in [w for w in WORKER_SESSIONS if w != WORKER_ID]:
+        apply_event('worker_gone', {'worker': worker})
+
+def encode_frame(event, payload):
+    body = json.dumps([event, payload], separators=(',', ':')).encode('utf-8')
+    return struct.pack('>I', len(body)) + body
+
+def read_frames(sock):
+    reader = sock.makefile('rb')
+    while True:
+        header = reader.read(4)
+        if len(header) < 4:
+            return
+        size = struct.unpack('>I', header)[0]
+        if size > BUS_MAX_FRAME:
+            return
+        body = reader.read(size)
+        if len(body) < size:
+            return
+        yield json.loads(body)
+
+def write_frames(sock, queue):
+    try:
+        while True:
+            sock.sendall(queue.get())
+    except OSError:
+        pass
+
+class LocalBus:
+    """A single server process, which is its own hub."""
+    is_hub = True
+
+    def start(self):
+        pass
+
+    def publish(self, event, payload):
+        stamp_event(event, payload)
+        record_event(event, payload)
+        apply_event(event, payload)
+
+class SocketBus:
+    """Server processes on one host share events over a TCP or unix socket.
+
+    Whichever process binds the address first is the hub and relays every
+    event to all connected processes. If the hub goes away the others compete
+    for the address again.
+    """
+
+    def __init__(self, family, address):
+        self.family = family
+        self.address = address
+        self.is_hub = False
+        # Outgoing frames per connected process, only used by the hub: {socket: Queue}
+        self.peers = {}
+        # Events published while not the hub, waiting to be sent to it: (event, payload, frame)
+        self.outbox = eventlet.queue.Queue()
+
+    def start(self):
+        socketio.start_background_task(self.run)
+
+    def publish(self, event, payload):
+        # Frames are encoded right away, so a payload that can't be sent fails
+        # in the caller rather than in a writer thread
+        if self.is_hub:
+            self.relay(event, payload)
+        else:
+            self.outbox.put((event, payload, encode_frame(event, payload)))
+
+    def relay(self, event, payload):
+        stamp_event(event, payload)
+        frame = encode_frame(event, payload)
+        record_event(event, payload)
+        for queue in self.peers.values():
+            queue.put(frame)
+        apply_event(event, payload)
+
+    def run(self):
+        while True:
+            try:
+                server = eventlet.listen(self.address, self.family, reuse_port=False)
+            except OSError:
+                self.join_hub()
+            else:
+                self.serve_hub(server)
+
+    def serve_hub(self, server):
+        self.is_hub = True
+        become_hub()
+        while not self.outbox.empty():
+            event, payload, _ = self.outbox.get()
+            self.relay(event, payload)
+        while True:
+            sock, _ = server.accept()
+            socketio.start_background_task(self.serve_peer, sock)
+
+    def serve_peer(self, sock):
+        queue = eventlet.queue.Queue()
+        writer = eventlet.spawn(write_frames, sock, queue)
+        worker = None
+        try:
+            for event, payload in read_frames(sock):
+                if event == 'hello':
+                    worker = payload['worker']
+                    queue.put(encode_frame('sync', roster_snapshot()))
+                    self.peers[sock] = queue
+                    for sid, username, channels in payload['sessions']:
+                        self.relay('session', {'sid': sid, 'username': username, 'worker': worker})
+                        for channel in channels:
+                            self.relay('join', {'sid': sid, 'channel': channel})
+                else:
+                    self.relay(event, payload)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.peers.pop(sock, None)
+            writer.kill()
+            sock.close()
+            if worker is not None:
+                self.relay('worker_gone', {'worker': worker})
+
+    def join_hub(self):
+        try:
+            sock = eventlet.connect(self.address, self.family)
+        except OSError:
+            if self.family == socket.AF_UNIX and os.path.exists(self.address):
+                # Nobody is listening, the socket file was left behind by a dead hub
+                os.unlink(self.address)
+            else:
+                socketio.sleep(1)
+            return
+        writer = None
+        try:
+            sock.sendall(encode_frame('hello', {'worker': WORKER_ID, 'sessions': local_sessions()}))
+            writer = eventlet.spawn(self.forward, sock)
+            for event, payload in read_frames(sock):
+                apply_event(event, payload)
+        except (OSError, ValueError):
+            pass
+        finally:
+            if writer is not None:
+                writer.kill()
+            sock.close()
+            # The next hub sends its own snapshot of everyone else
+            forget_remote_sessions()
+
+    def forward(self, sock):
+        try:
+            while True:
+                sock.sendall(self.outbox.get()[2])
+        except OSError:
+            pass
+
+def create_bus(url):
+    """local, tcp://host:port or unix:///path/to/socket"""
+    if url == 'local':
+        return LocalBus()
+    if url.startswith('tcp://'):
+        host, port = url[len('tcp://'):].rsplit(':', 1)
+        return SocketBus(socket.AF_INET, (host, int(port)))
+    if url.startswith('unix://'):
+        return SocketBus(socket.AF_UNIX, url[len('unix://'):])
+    raise ValueError('Unknown bus: %s' % url)
+
+BUS = create_bus(os.environ.get('LANCHAT_BUS', 'local'))
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        try:
+            worker.wait(5)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+
+def watch_parent(pid):
+    # A worker started with --workers goes away with the process that started it,
+    # even if that one was killed without a chance to stop it
+    while os.getppid() == pid:
+        socketio.sleep(1)
+    os.kill(os.getpid(), signal.SIGTERM)
 
 if __name__ == '__main__':
-    print("[*] Server running on http://0.0.0.0:8080")
-    socketio.run(app, host='0.0.0.0', port=8080, debug=False)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='LAN Chat server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of server processes, on consecutive ports')
+    parser.add_argument('--bus', help='bus shared by the server processes: local, '
+                                      'tcp://host:port or unix:///path (default: tcp on port + 1000)')
+    parser.add_argument('--parent', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    # Exit normally on SIGTERM so the atexit handlers (message log, workers) run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.workers > 1 and not args.bus:
+        args.bus = 'tcp://127.0.0.1:%d' % (args.port + 1000)
+    if args.bus:
+        BUS = create_bus(args.bus)
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--port', str(args.port + i),
+                                 '--bus', args.bus, '--parent', str(os.getpid())])
+               for i in range(1, args.workers)]
+    atexit.register(stop_workers, workers)
+    if args.parent:
+        socketio.start_background_task(watch_parent, args.parent)
+    BUS.start()
+    print("[*] Server running on http://0.0.0.0:%d" % args.port)
+    socketio.run(app, host='0.0.0.0', port=args.port, debug=False)
\ No newline at end of file
@@ -0,0 +1,214 @@
+/* Minimal MessagePack encoder/decoder for the chat's binary Socket.IO payloads. */
+(function (global) {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    function Writer() {
+        this.buffer = new Uint8Array(256);
+        this.view = new DataView(this.buffer.buffer);
+        this.length = 0;
+    }
+
+    Writer.prototype.reserve = function (size) {
+        if (this.length + size <= this.buffer.length) return;
+        let capacity = this.buffer.length * 2;
+        while (capacity < this.length + size) capacity *= 2;
+        const buffer = new Uint8Array(capacity);
+        buffer.set(this.buffer.subarray(0, this.length));
+        this.buffer = buffer;
+        this.view = new DataView(buffer.buffer);
+    };
+
+    Writer.prototype.byte = function (value) {
+        this.reserve(1);
+        this.buffer[this.length++] = value;
+    };
+
+    Writer.prototype.uint16 = function (value) {
+        this.reserve(2);
+        this.view.setUint16(this.length, value);
+        this.length += 2;
+    };
+
+    Writer.prototype.uint32 = function (value) {
+        this.reserve(4);
+        this.view.setUint32(this.length, value);
+        this.length += 4;
+    };
+
+    Writer.prototype.bytes = function (bytes) {
+        this.reserve(bytes.length);
+        this.buffer.set(bytes, this.length);
+        this.length += bytes.length;
+    };
+
+    function writeLength(writer, length, fix, fixMax, codes) {
+        if (fix !== null && length <= fixMax) {
+            writer.byte(fix | length);
+        } else if (codes[0] !== null && length < 0x100) {
+            writer.byte(codes[0]);
+            writer.byte(length);
+        } else if (length < 0x10000) {
+            writer.byte(codes[1]);
+            writer.uint16(length);
+        } else {
+            writer.byte(codes[2]);
+            writer.uint32(length);
+        }
+    }
+
+    function writeNumber(writer, value) {
+        if (!Number.isSafeInteger(value)) {
+            writer.byte(0xcb);
+            writer.reserve(8);
+            writer.view.setFloat64(writer.length, value);
+            writer.length += 8;
+        } else if (value >= 0 && value < 0x80) {
+            writer.byte(value);
+        } else if (value < 0 && value >= -32) {
+            writer.byte(0x100 + value);
+        } else if (value >= 0) {
+            if (value < 0x100) { writer.byte(0xcc); writer.byte(value); }
+            else if (value < 0x10000) { writer.byte(0xcd); writer.uint16(value); }
+            else if (value < 0x100000000) { writer.byte(0xce); writer.uint32(value); }
+            else {
+                writer.byte(0xcf);
+                writer.reserve(8);
+                writer.view.setBigUint64(writer.length, BigInt(value));
+                writer.length += 8;
+            }
+        } else {
+            writer.byte(0xd3);
+            writer.reserve(8);
+            writer.view.setBigInt64(writer.length, BigInt(value));
+            writer.length += 8;
+        }
+    }
+
+    function write(writer, value) {
+        if (value === null || value === undefined) {
+            writer.byte(0xc0);
+        } else if (value === false) {
+            writer.byte(0xc2);
+        } else if (value === true) {
+            writer.byte(0xc3);
+        } else if (typeof value === 'number') {
+            writeNumber(writer, value);
+        } else if (typeof value === 'string') {
+            const bytes = textEncoder.encode(value);
+            writeLength(writer, bytes.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+            writer.bytes(bytes);
+        } else if (value instanceof ArrayBuffer || ArrayBuffer.isView(value)) {
+            const bytes = value instanceof ArrayBuffer
+                ? new Uint8Array(value)
+                : new Uint8Array(value.buffer, value.byteOffset, value.byteLength);
+            writeLength(writer, bytes.length, null, 0, [0xc4, 0xc5, 0xc6]);
+            writer.bytes(bytes);
+        } else if (Array.isArray(value)) {
+            writeLength(writer, value.length, 0x90, 15, [null, 0xdc, 0xdd]);
+            value.forEach(item => write(writer, item));
+        } else {
+            const keys = Object.keys(value).filter(key => value[key] !== undefined);
+            writeLength(writer, keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+            keys.forEach(key => {
+                write(writer, key);
+                write(writer, value[key]);
+            });
+        }
+    }
+
+    function encode(value) {
+        const writer = new Writer();
+        write(writer, value);
+        return writer.buffer.slice(0, writer.length);
+    }
+
+    function decode(data) {
+        const bytes = data instanceof ArrayBuffer ? new Uint8Array(data) : data;
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function take(size) {
+            const start = offset;
+            offset += size;
+            return start;
+        }
+
+        function str(size) {
+            const start = take(size);
+            return textDecoder.decode(bytes.subarray(start, start + size));
+        }
+
+        function bin(size) {
+            const start = take(size);
+            return bytes.slice(start, start + size);
+        }
+
+        function array(size) {
+            const result = new Array(size);
+            for (let i = 0; i < size; i++) result[i] = read();
+            return result;
+        }
+
+        function map(size) {
+            const result = {};
+            for (let i = 0; i < size; i++) {
+                const key = read();
+                result[key] = read();
+            }
+            return result;
+        }
+
+        function ext(size) {
+            take(1 + size);  // Extension types aren't used by the server
+            return null;
+        }
+
+        function read() {
+            const code = bytes[take(1)];
+            if (code < 0x80) return code;
+            if (code < 0x90) return map(code & 0x0f);
+            if (code < 0xa0) return array(code & 0x0f);
+            if (code < 0xc0) return str(code & 0x1f);
+            if (code >= 0xe0) return code - 0x100;
+            switch (code) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(view.getUint8(take(1)));
+                case 0xc5: return bin(view.getUint16(take(2)));
+                case 0xc6: return bin(view.getUint32(take(4)));
+                case 0xc7: return ext(view.getUint8(take(1)));
+                case 0xc8: return ext(view.getUint16(take(2)));
+                case 0xc9: return ext(view.getUint32(take(4)));
+                case 0xca: return view.getFloat32(take(4));
+                case 0xcb: return view.getFloat64(take(8));
+                case 0xcc: return view.getUint8(take(1));
+                case 0xcd: return view.getUint16(take(2));
+                case 0xce: return view.getUint32(take(4));
+                case 0xcf: return Number(view.getBigUint64(take(8)));
+                case 0xd0: return view.getInt8(take(1));
+                case 0xd1: return view.getInt16(take(2));
+                case 0xd2: return view.getInt32(take(4));
+                case 0xd3: return Number(view.getBigInt64(take(8)));
+                case 0xd4: return ext(1);
+                case 0xd5: return ext(2);
+                case 0xd6: return ext(4);
+                case 0xd7: return ext(8);
+                case 0xd8: return ext(16);
+                case 0xd9: return str(view.getUint8(take(1)));
+                case 0xda: return str(view.getUint16(take(2)));
+                case 0xdb: return str(view.getUint32(take(4)));
+                case 0xdc: return array(view.getUint16(take(2)));
+                case 0xdd: return array(view.getUint32(take(4)));
+                case 0xde: return map(view.getUint16(take(2)));
+                case 0xdf: return map(view.getUint32(take(4)));
+            }
+            throw new Error('Invalid MessagePack byte 0x' + code.toString(16));
+        }
+
+        return read();
+    }
+
+    global.msgpack = { encode: encode, decode: decode };
+})(window);